@@ -1,23 +1,30 @@
 import os
 import logging
-import random
 import hashlib
+import hmac
 import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import time
 import calendar
-from datetime import datetime, timedelta
-from flask import Flask
+from datetime import date, datetime, timedelta
+from aiohttp import web
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 import asyncio
-import json
-import string
+import itertools
+from enum import IntEnum
+import re
+from collections import defaultdict
+from types import MappingProxyType
 from urllib.parse import urlparse
-from flask import Flask
 import signal
-import requests
 from telegram.request import HTTPXRequest
+from telegram.error import RetryAfter
 # 配置日志 - 减少噪音
 logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s',
@@ -36,10 +43,57 @@ logger = logging.getLogger(__name__)
 # 环境变量
 TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 DATABASE_URL = os.getenv('DATABASE_URL')
+# 设置了公网地址时使用 webhook 接收更新，否则回退到长轮询（本地开发）
+WEBHOOK_URL = os.getenv('WEBHOOK_URL') or os.getenv('RENDER_EXTERNAL_URL')
+WEBHOOK_PATH = '/telegram'
+# Render 分配的端口，由内置的 aiohttp 服务器绑定：健康检查，以及 webhook 模式下接收更新
+PORT = int(os.environ.get('PORT', 10000))
+# 长轮询时 getUpdates 的挂起时长（秒）
+POLL_TIMEOUT = 30
+# Telegram 在每个 webhook 请求头里带上这个值，用于拒绝伪造的更新
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256(f"webhook:{TOKEN}".encode()).hexdigest()
 
+# 全局连接池
+db_pool = None
 
-# 只保留繁体中文文本
-TEXTS = {
+# 用户房间列表缓存：user_id -> (过期时间, rooms)，成员关系变化时主动失效
+USER_ROOMS_CACHE_TTL = 60
+USER_ROOMS_CACHE_MAX = 10000
+_USER_ROOMS_CACHE = {}
+
+# 房间成员缓存：room_code -> (过期时间, 成员 user_id 元组)，同样在成员关系变化时失效
+ROOM_MEMBERS_CACHE_TTL = 60
+ROOM_MEMBERS_CACHE_MAX = 1000
+_ROOM_MEMBERS_CACHE = {}
+
+# 房间待办的版本号：本进程内每次增删待办时递增，用于判断缓存是否过期
+_ROOM_VERSIONS = defaultdict(int)
+# 删除键盘缓存：(room_code, 页码) -> (过期时间, 版本号, 键盘)
+# 与其他缓存一样限定 TTL 和条目数，已删除或无人使用的房间不会一直占着内存
+DELETE_KB_CACHE_TTL = 60
+DELETE_KB_CACHE_MAX = 1000
+_DELETE_KB_CACHE = {}
+
+def bump_room_version(room_code):
+    _ROOM_VERSIONS[room_code] += 1
+
+# 后台任务需要保留强引用，否则可能在完成前被回收，异常也会丢失
+BACKGROUND_TASKS = set()
+
+def _on_background_done(task):
+    BACKGROUND_TASKS.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("後台任務失敗: %s", task.exception())
+
+def spawn_background(coro):
+    """在事件循环中调度协程并跟踪，直到完成"""
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_on_background_done)
+    return task
+
+# 只保留繁体中文文本（只读，防止运行时被意外修改）
+TEXTS = MappingProxyType({
     'welcome': '👋 歡迎使用待辦事項機器人！\n使用 /help 查看幫助',
     'main_menu': '🏠 主選單 - 請選擇操作：',
     'query_all': '📋 所有待辦事項',
@@ -87,8 +141,14 @@ TEXTS = {
     'reminder_message': '🔔 提醒：{}',
     'no_reminder': '✅ 已跳過提醒設置',
     'no_tasks_category': '📭 該類別目前沒有待辦事項',
-    'choose_task_to_delete': '🗑️ 請選擇要刪除的待辦事項：'
-}
+    'choose_task_to_delete': '🗑️ 請選擇要刪除的待辦事項：',
+    'next_page': '➡️ 下一頁',
+    'no_more_tasks': '📭 沒有更多待辦事項'
+})
+
+# 每页待办数量，以及单条消息的字符上限（Telegram 限制为 4096）
+TODO_PAGE_SIZE = 50
+MAX_MESSAGE_CHARS = 3500
 
 # Categories
 CATEGORIES = {
@@ -96,23 +156,33 @@ CATEGORIES = {
     'movie': '📺 影視',
     'action': '⭐ 行動'
 }
-def signal_handler(signum, frame):
-    logger.info(f"Received signal {signum}. Shutting down gracefully...")
-    
-    # 创建一个新的事件循环来运行异步关闭代码
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    
-    try:
-        # 停止轮询，允许当前正在处理的任务完成
-        if application.running:
-            loop.run_until_complete(application.stop())
-        # 这里可以添加其他清理工作，如关闭数据库连接池
-        logger.info("Bot shutdown complete.")
-    except Exception as e:
-        logger.error(f"Error during shutdown: {e}")
-    finally:
-        loop.close()
+# 固定顺序的 (id, 名称) 元组，用于遍历；按 id 查名称仍用上面的字典
+CATEGORY_ITEMS = tuple(CATEGORIES.items())
+# 类别排序键，写入 todos.category_order，使“全部”查询可直接按索引顺序返回；未知类别排最后
+CATEGORY_ORDER = {cat: i for i, cat in enumerate(CATEGORIES, 1)}
+CATEGORY_ORDER_OTHER = len(CATEGORY_ORDER) + 1
+
+# 房间选择回调使用短操作码，避免把多字节文本塞进 callback_data（上限 64 字节）
+OP_CODES = {
+    TEXTS['query_all']: 0,
+    TEXTS['query_category']: 1,
+    TEXTS['add_todo']: 2,
+    TEXTS['delete_todo']: 3
+}
+
+# 需要先确定当前房间的待办操作
+_TODO_ACTIONS = frozenset(OP_CODES)
+
+# 对话状态，保存在 context.user_data['state']，同一时间只有一个
+class S(IntEnum):
+    IDLE = 0
+    WAIT_ROOM_NAME = 1
+    WAIT_ROOM_PW = 2
+    WAIT_ROOM_CODE = 3
+    WAIT_JOIN_PW = 4
+    WAIT_TASK = 5
+    WAIT_CUSTOM_TIME = 7
+
 # 解析 DATABASE_URL 到 dsn
 def parse_database_url(url):
     parsed = urlparse(url)
@@ -120,280 +190,394 @@ def parse_database_url(url):
     port = parsed.port if parsed.port else 5432
     return (
         f"dbname={parsed.path[1:]} user={parsed.username} password={parsed.password} "
-        f"host={parsed.hostname} port={port} sslmode=require"
+        f"host={parsed.hostname} port={port} sslmode=require "
+        # TCP keepalive 让失效的连接尽快被发现，而不是在下一次查询时才报错
+        "keepalives=1 keepalives_idle=30 keepalives_interval=10 keepalives_count=3 "
+        "tcp_user_timeout=15000"
     )
 
 
-# 初始化数据库  
+class PreparedConnection(psycopg2.extensions.connection):
+    """记录已在本连接上 PREPARE 过的语句名"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+_db_pool_lock = threading.Lock()
+
+# 初始化数据库连接池（可重复调用，只会创建一次）
+def init_db_pool():
+    global db_pool, get_db_connection, put_db_connection
+    with _db_pool_lock:
+        if db_pool is not None:
+            return db_pool
+        try:
+            db_pool = psycopg2.pool.ThreadedConnectionPool(
+                minconn=5,
+                maxconn=50,
+                dsn=parse_database_url(DATABASE_URL),
+                connection_factory=PreparedConnection
+            )
+            logger.info("Database connection pool initialized")
+        except Exception as e:
+            logger.critical("Database pool initialization failed: %s", e)
+            raise
+        # 直接绑定到连接池的方法，热路径上不再检查 db_pool 是否为空
+        get_db_connection = db_pool.getconn
+        put_db_connection = db_pool.putconn
+        return db_pool
+
+def close_db_pool():
+    """关闭连接池中的所有连接，退出前调用"""
+    with _db_pool_lock:
+        if db_pool is not None and not db_pool.closed:
+            db_pool.closeall()
+            logger.info("Database connection pool closed")
 
 def get_db_connection():
+    # 连接池初始化后会被替换为 db_pool.getconn
+    raise Exception("Database connection pool is not initialized")
+
+def put_db_connection(conn, close=False):
+    # 连接池初始化后会被替换为 db_pool.putconn
+    raise Exception("Database connection pool is not initialized")
+
+@contextmanager
+def db_cursor():
+    """借出连接并返回游标：正常结束时提交，出错时回滚，最后总是归还连接"""
+    conn = get_db_connection()
+    if conn.closed:
+        # 连接已被服务端或网络断开，丢弃后重新借一个
+        put_db_connection(conn, close=True)
+        conn = get_db_connection()
     try:
-        dsn = parse_database_url(DATABASE_URL)
-        return psycopg2.connect(dsn)
-    except Exception as e:
-        logger.error(f"Database connection failed: {e}")
+        yield conn.cursor()
+        conn.commit()
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
         raise
+    finally:
+        # 连接在使用中断开（OperationalError）时关闭它，而不是放回池中
+        put_db_connection(conn, close=bool(conn.closed))
 
-def put_db_connection(conn):
-    if conn:
-        conn.close()
+def execute_prepared(c, name, sql, params):
+    """首次在连接上 PREPARE，之后只发送 EXECUTE，省去服务端的解析和规划"""
+    conn = c.connection
+    if name not in conn.prepared:
+        c.execute(f"PREPARE {name} AS {sql}")
+        conn.prepared.add(name)
+    placeholders = ", ".join(["%s"] * len(params))
+    c.execute(f"EXECUTE {name} ({placeholders})", params)
 
 # 房间管理功能
-def generate_room_code():
-    """生成4位数房间号"""
-    return str(random.randint(1000, 9999))
-
 def hash_password(password):
     """密码哈希处理"""
     return hashlib.sha256(password.encode()).hexdigest()
 
+# 默認房間密碼的哈希只需計算一次
+_DEFAULT_ROOM_PW_HASH = hash_password('default')
+
+def ensure_default_room(c):
+    """默認房間不存在時才插入，已存在則只需一次查詢"""
+    c.execute("SELECT 1 FROM rooms WHERE room_code = 'default_room'")
+    if not c.fetchone():
+        c.execute("""
+            INSERT INTO rooms (room_code, room_name, password, owner_id)
+            VALUES ('default_room', '默認房間', %s, 0)
+            ON CONFLICT (room_code) DO NOTHING
+        """, (_DEFAULT_ROOM_PW_HASH,))
+
+# 生成房间号时的最大重试次数
+ROOM_CODE_ATTEMPTS = 5
+
 def create_room(room_name, password, owner_id):
     """创建房间"""
-    conn = get_db_connection()
     try:
-        c = conn.cursor()
-        room_code = generate_room_code()
-    
-        # 确保房间号不重复
-        while True:
-            c.execute("SELECT room_code FROM rooms WHERE room_code = %s", (room_code,))
-            if not c.fetchone():
-                break
-            room_code = generate_room_code()
-    
-        hashed_password = hash_password(password)
-        c.execute("""
-            INSERT INTO rooms (room_code, room_name, password, owner_id)
-            VALUES (%s, %s, %s, %s)
-        """, (room_code, room_name, hashed_password, owner_id))
-    
-        # 自动将创建者加入房间
-        c.execute("""
-            INSERT INTO room_members (room_code, user_id)
-            VALUES (%s, %s)
-        """, (room_code, owner_id))
-    
-        conn.commit()
+        with db_cursor() as c:
+            # 由数据库生成4位数房间号，冲突时重试，无需先查询；密码用 pgcrypto 加盐哈希
+            room_code = None
+            for _ in range(ROOM_CODE_ATTEMPTS):
+                c.execute("""
+                    INSERT INTO rooms (room_code, room_name, password, owner_id)
+                    VALUES (lpad((floor(random() * 9000) + 1000)::int::text, 4, '0'), %s, crypt(%s, gen_salt('bf')), %s)
+                    ON CONFLICT (room_code) DO NOTHING
+                    RETURNING room_code
+                """, (room_name, password, owner_id))
+                row = c.fetchone()
+                if row:
+                    room_code = row[0]
+                    break
+            if room_code is None:
+                raise Exception("無法生成唯一的房間號")
+
+            # 自动将创建者加入房间
+            c.execute("""
+                INSERT INTO room_members (room_code, user_id)
+                VALUES (%s, %s)
+            """, (room_code, owner_id))
+
+        # 提交之后再使缓存失效
+        invalidate_membership(owner_id, room_code)
         return room_code
     except Exception as e:
-        logger.error(f"Error creating room: {e}")
-        conn.rollback()
+        logger.error("Error creating room: %s", e)
         raise
-    finally:
-        put_db_connection(conn)
 
 def join_room(room_code, password, user_id):
     """加入房间"""
-    conn = get_db_connection()
     try:
-        c = conn.cursor()
-    
-        # 验证房间和密码
-        c.execute("SELECT password, room_name FROM rooms WHERE room_code = %s", (room_code,))
-        result = c.fetchone()
+        with db_cursor() as c:
+            # 在数据库端验证密码并加入房间，一次往返完成
+            # 旧房间保存的是无盐 SHA-256 十六进制，新房间是 bcrypt（$2 开头）
+            execute_prepared(c, "join_room", """
+                WITH r AS (
+                    SELECT room_name,
+                        CASE WHEN password LIKE '$2%'
+                            THEN password = crypt($3::text, password)
+                            ELSE password = encode(digest($3::text, 'sha256'), 'hex')
+                        END AS ok
+                    FROM rooms
+                    WHERE room_code = $1::text
+                ), ins AS (
+                    INSERT INTO room_members (room_code, user_id)
+                    SELECT $1::text, $2::bigint FROM r WHERE r.ok
+                    ON CONFLICT (room_code, user_id) DO NOTHING
+                )
+                SELECT room_name, ok FROM r
+            """, (room_code, user_id, password))
+            result = c.fetchone()
         if not result:
             return False, "房間不存在"
-    
-        hashed_password, room_name = result
-        if hash_password(password) != hashed_password:
+
+        room_name, ok = result
+        if not ok:
             return False, "密碼錯誤"
-    
-        # 加入房间
-        try:
-            c.execute("""
-                INSERT INTO room_members (room_code, user_id)
-                VALUES (%s, %s)
-                ON CONFLICT (room_code, user_id) DO NOTHING
-            """, (room_code, user_id))
-            conn.commit()
-            return True, room_name
-        except Exception as e:
-            logger.error(f"Error joining room: {e}")
-            return False, "加入失敗"
-        
+        invalidate_membership(user_id, room_code)
+        return True, room_name
+
     except Exception as e:
-        logger.error(f"Error in join_room: {e}")
+        logger.error("Error in join_room: %s", e)
         return False, "系統錯誤"
-    finally:
-        put_db_connection(conn)
 
 def leave_room(room_code, user_id):
     """离开房间"""
-    conn = get_db_connection()
     try:
-        c = conn.cursor()
-      
-        # 获取房间名称用于返回
-        c.execute("SELECT room_name FROM rooms WHERE room_code = %s", (room_code,))
-        result = c.fetchone()
-        if not result:
+        with db_cursor() as c:
+            # 一次往返内取房间名称并离开房间
+            execute_prepared(c, "leave_room", """
+                WITH r AS (
+                    SELECT room_name FROM rooms WHERE room_code = $1::text
+                ), d AS (
+                    DELETE FROM room_members
+                    WHERE room_code = $1::text AND user_id = $2::bigint
+                    RETURNING 1
+                )
+                SELECT (SELECT room_name FROM r), (SELECT count(*) FROM d)
+            """, (room_code, user_id))
+            room_name, deleted = c.fetchone()
+
+        if room_name is None:
             return False, "房間不存在"
-      
-        room_name = result[0]
-      
-        # 离开房间
-        c.execute("""
-            DELETE FROM room_members 
-            WHERE room_code = %s AND user_id = %s
-        """, (room_code, user_id))
-      
-        conn.commit()
-        success = c.rowcount > 0
-      
-        if success:
+        if deleted:
+            invalidate_membership(user_id, room_code)
             return True, room_name
         else:
             return False, "您不在該房間中"
-          
+
     except Exception as e:
-        logger.error(f"Error leaving room: {e}")
+        logger.error("Error leaving room: %s", e)
         return False, "系統錯誤"
-    finally:
-        put_db_connection(conn)
+
+def invalidate_membership(user_id, room_code):
+    """用户加入或离开房间后，同时丢弃两边的缓存"""
+    _USER_ROOMS_CACHE.pop(user_id, None)
+    _ROOM_MEMBERS_CACHE.pop(room_code, None)
 
 def get_user_rooms(user_id):
-    """获取用户加入的所有房间"""
-    conn = get_db_connection()
+    """获取用户加入的所有房间（带 TTL 缓存）"""
+    cached = _USER_ROOMS_CACHE.get(user_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
     try:
-        c = conn.cursor()
-        c.execute("""
-            SELECT r.room_code, r.room_name 
-            FROM rooms r
-            JOIN room_members rm ON r.room_code = rm.room_code
-            WHERE rm.user_id = %s
-            ORDER BY rm.joined_at DESC
-        """, (user_id,))
-        rooms = c.fetchall()
-        return rooms
+        with db_cursor() as c:
+            execute_prepared(c, "get_user_rooms", """
+                SELECT r.room_code, r.room_name 
+                FROM rooms r
+                JOIN room_members rm ON r.room_code = rm.room_code
+                WHERE rm.user_id = $1
+                ORDER BY rm.joined_at DESC
+            """, (user_id,))
+            rooms = c.fetchall()
+            if len(_USER_ROOMS_CACHE) >= USER_ROOMS_CACHE_MAX:
+                _USER_ROOMS_CACHE.clear()
+            _USER_ROOMS_CACHE[user_id] = (time.monotonic() + USER_ROOMS_CACHE_TTL, rooms)
+            return rooms
     except Exception as e:
-        logger.error(f"Error getting user rooms: {e}")
+        logger.error("Error getting user rooms: %s", e)
         return []
-    finally:
-        put_db_connection(conn)
 
-def get_room_members(room_code):
-    """获取房间所有成员的用户ID"""
-    conn = get_db_connection()
+def get_room_members(room_code, exclude_user_id=None):
+    """获取房间所有成员的用户ID（带 TTL 缓存），可排除某个用户"""
+    cached = _ROOM_MEMBERS_CACHE.get(room_code)
+    if cached and cached[0] > time.monotonic():
+        members = cached[1]
+    else:
+        try:
+            with db_cursor() as c:
+                execute_prepared(c, "get_room_members", """
+                    SELECT user_id
+                    FROM room_members 
+                    WHERE room_code = $1
+                """, (room_code,))
+                members = tuple(row[0] for row in c.fetchall())
+        except Exception as e:
+            logger.error("获取房间成员失败: %s", e)
+            return []
+        if len(_ROOM_MEMBERS_CACHE) >= ROOM_MEMBERS_CACHE_MAX:
+            _ROOM_MEMBERS_CACHE.clear()
+        _ROOM_MEMBERS_CACHE[room_code] = (time.monotonic() + ROOM_MEMBERS_CACHE_TTL, members)
+    return [user_id for user_id in members if user_id != exclude_user_id]
+
+# 广播类消息（房间通知、提醒）经发送队列限速，避免超过 Telegram 约 30 条/秒的全局限制
+# 直接回复用户的消息不经过队列；队列内提醒优先于房间通知
+SEND_RATE = 25
+SEND_QUEUE_MAX = 10000
+SEND_MAX_IN_FLIGHT = 25  # Telegram 变慢时限制同时进行中的发送数
+PRIORITY_REMINDER = 0
+PRIORITY_NOTIFICATION = 1
+# 同一聊天两条广播之间的最小间隔（秒），Telegram 对单个聊天约限 1 条/秒
+SEND_CHAT_INTERVAL = 1.0
+
+_send_queue = None
+_send_worker_task = None
+_send_slots = None
+_send_seq = itertools.count()  # 同优先级按入队顺序发送
+_chat_next_send = {}  # chat_id -> 下次允许发送的时间（loop.time()）
+# 提醒 id -> 尚未送达的消息数；全部送达后才把提醒标记为已触发，
+# 停机时还在队列里的提醒保持未触发，重启后会被恢复并重新发送
+_reminder_pending = {}
+
+async def enqueue_message(chat_id, text, priority=PRIORITY_NOTIFICATION, reminder_id=None):
+    """把消息放入发送队列，队列满时等待；reminder_id 用于在送达后标记提醒"""
+    await _send_queue.put((priority, next(_send_seq), chat_id, text, reminder_id))
+
+def _settle_reminder(reminder_id):
+    """提醒的一条消息已有结果（送达或不可重试的失败），最后一条时标记为已触发"""
+    left = _reminder_pending.get(reminder_id, 1) - 1
+    if left > 0:
+        _reminder_pending[reminder_id] = left
+        return
+    _reminder_pending.pop(reminder_id, None)
+    spawn_background(asyncio.to_thread(mark_reminder_fired, reminder_id))
+
+async def _deliver(bot, item):
+    priority, seq, chat_id, text, reminder_id = item
+    retry_after = None
     try:
-        c = conn.cursor()
-        c.execute("""
-            SELECT user_id
-            FROM room_members 
-            WHERE room_code = %s
-        """, (room_code,))
-        return [row[0] for row in c.fetchall()]
+        await bot.send_message(chat_id=chat_id, text=text)
+    except RetryAfter as e:
+        retry_after = e.retry_after
     except Exception as e:
-        logger.error(f"获取房间成员失败: {e}")
-        return []
+        logger.error("Failed to send message to %s: %s", chat_id, e)
     finally:
-        put_db_connection(conn)
+        _send_slots.release()
+    if retry_after is None and reminder_id is not None:
+        _settle_reminder(reminder_id)
+    if retry_after is not None:
+        # 被限流时按要求等待，再以原来的顺序号放回队列
+        logger.warning("發送被限流，%s 秒後重試: %s", retry_after, chat_id)
+        await _requeue_later(item, retry_after)
 
-async def notify_room_members(room_code, message, context: ContextTypes.DEFAULT_TYPE):
-    """向房间所有成员发送通知"""
-    conn = get_db_connection()
+async def _requeue_later(item, delay):
+    await asyncio.sleep(delay)
+    await _send_queue.put(item)
+
+def _reserve_chat(chat_id, now):
+    """同一聊天发送过密时返回需等待的秒数；否则占用该聊天的下一个发送时间并返回 0"""
+    ready_at = _chat_next_send.get(chat_id, 0)
+    if ready_at > now:
+        return ready_at - now
+    if len(_chat_next_send) >= SEND_QUEUE_MAX:
+        # 只保留仍在间隔内的记录，避免字典无限增长
+        for key in [k for k, t in _chat_next_send.items() if t <= now]:
+            del _chat_next_send[key]
+    _chat_next_send[chat_id] = now + SEND_CHAT_INTERVAL
+    return 0
+
+async def _send_worker(bot):
+    """按 SEND_RATE 的速率依次启动发送，发送本身并发进行，同时进行中的不超过 SEND_MAX_IN_FLIGHT"""
+    loop = asyncio.get_running_loop()
+    interval = 1 / SEND_RATE
+    while True:
+        item = await _send_queue.get()
+        wait = _reserve_chat(item[2], loop.time())
+        if wait:
+            # 该聊天刚发过，稍后再放回队列，不占用全局发送速率
+            spawn_background(_requeue_later(item, wait))
+            _send_queue.task_done()
+            continue
+        await _send_slots.acquire()
+        started = loop.time()
+        spawn_background(_deliver(bot, item))
+        _send_queue.task_done()
+        await asyncio.sleep(max(0, interval - (loop.time() - started)))
+
+async def start_send_queue(application):
+    global _send_queue, _send_worker_task, _send_slots
+    _send_queue = asyncio.PriorityQueue(maxsize=SEND_QUEUE_MAX)
+    _send_slots = asyncio.Semaphore(SEND_MAX_IN_FLIGHT)
+    _send_worker_task = asyncio.create_task(_send_worker(application.bot))
+
+async def on_startup(application):
+    """开始接收更新前：启动发送队列和 HTTP 服务器，并恢复重启前安排的提醒"""
+    await start_send_queue(application)
+    await start_web_server(application, PORT)
+    await restore_reminders(application)
+
+async def on_shutdown(application):
+    await stop_send_queue(application)
+    await stop_web_server()
+    # 此时更新和任务都已停止，不会再借用连接
+    await asyncio.to_thread(close_db_pool)
+
+async def stop_send_queue(application):
+    if _send_worker_task:
+        _send_worker_task.cancel()
+
+async def notify_room_members(room_code, message, context: ContextTypes.DEFAULT_TYPE, actor_id=None):
+    """向房间其他成员发送通知（不回发给操作者本人）"""
+    # 查询放到线程池，避免阻塞事件循环
+    members = await asyncio.to_thread(get_room_members, room_code, actor_id)
+    # 通知文本对所有成员相同，只格式化一次
+    text = TEXTS['room_notification'].format(message)
+    for user_id in members:
+        await enqueue_message(user_id, text)
+
+# Database functions
+def init_db():
+    """初始化數據庫"""
+    # 密碼哈希使用 pgcrypto 的 crypt()/gen_salt()。單獨一個事務創建：
+    # 角色無權創建擴展時直接報錯停止啟動，而不是連帶建表事務一起回滾、
+    # 再被下面吞掉異常，讓機器人對著一個沒有表的數據庫運行
     try:
-        c = conn.cursor()
-        c.execute("SELECT user_id FROM room_members WHERE room_code = %s", (room_code,))
-        members = c.fetchall()
-    
-        for (user_id,) in members:
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=TEXTS['room_notification'].format(message)
-                )
-            except Exception as e:
-                logger.error(f"Failed to notify user {user_id}: {e}")
+        with db_cursor() as c:
+            c.execute("CREATE EXTENSION IF NOT EXISTS pgcrypto")
     except Exception as e:
-        logger.error(f"Error notifying room members: {e}")
-    finally:
-        put_db_connection(conn)
+        logger.critical("無法創建 pgcrypto 擴展: %s", e)
+        raise
 
-def migrate_database():
-    """自動遷移數據庫結構"""
-    conn = get_db_connection()
     try:
-        c = conn.cursor()
-    
-        # 1. 首先檢查 todos 表是否存在
-        c.execute("""
-            SELECT EXISTS (
-                SELECT FROM information_schema.tables 
-                WHERE table_schema = 'public' 
-                AND table_name = 'todos'
-            )
-        """)
-        todos_table_exists = c.fetchone()[0]
-        
-        if not todos_table_exists:
-            logger.info("todos 表不存在，創建新表結構")
-            # 創建完整的表結構
+        with db_cursor() as c:
+            # 創建用戶表（必須最先創建）
             c.execute('''
-                CREATE TABLE rooms (
-                    room_code TEXT PRIMARY KEY,
-                    room_name TEXT,
-                    password TEXT,
-                    owner_id BIGINT,
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id BIGINT PRIMARY KEY, 
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
-            
-            c.execute('''
-                CREATE TABLE room_members (
-                    id SERIAL PRIMARY KEY,
-                    room_code TEXT,
-                    user_id BIGINT,
-                    joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY(room_code) REFERENCES rooms(room_code),
-                    UNIQUE(room_code, user_id)
-                )
-            ''')
-            
-            c.execute('''
-                CREATE TABLE todos (
-                    id SERIAL PRIMARY KEY, 
-                    room_code TEXT DEFAULT 'default_room',
-                    user_id BIGINT, 
-                    category TEXT,
-                    task TEXT, 
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY(room_code) REFERENCES rooms(room_code)
-                )
-            ''')
-            
-            # 創建默認房間
-            c.execute("""
-                INSERT INTO rooms (room_code, room_name, password, owner_id)
-                VALUES ('default_room', '默認房間', %s, 0)
-                ON CONFLICT (room_code) DO NOTHING
-            """, (hash_password('default'),))
-            
-            logger.info("新數據庫結構創建完成")
-            conn.commit()
-            return
-        
-        # 2. 如果 todos 表存在，檢查是否有 room_code 列
-        c.execute("""
-            SELECT column_name 
-            FROM information_schema.columns 
-            WHERE table_name = 'todos' AND column_name = 'room_code'
-        """)
-        has_room_code = c.fetchone()
-    
-        if not has_room_code:
-            logger.info("檢測到舊數據庫結構，開始遷移...")
-        
-            # 3. 檢查舊表的結構
-            c.execute("""
-                SELECT column_name, data_type 
-                FROM information_schema.columns 
-                WHERE table_name = 'todos' 
-                ORDER BY ordinal_position
-            """)
-            old_columns = c.fetchall()
-            logger.info(f"舊表結構: {old_columns}")
-        
-            # 4. 創建rooms表（如果不存在）
+
+            # 創建其他必要的表
             c.execute('''
                 CREATE TABLE IF NOT EXISTS rooms (
                     room_code TEXT PRIMARY KEY,
@@ -403,8 +587,7 @@ def migrate_database():
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
-            
-            # 5. 創建room_members表（如果不存在）
+
             c.execute('''
                 CREATE TABLE IF NOT EXISTS room_members (
                     id SERIAL PRIMARY KEY,
@@ -415,10 +598,9 @@ def migrate_database():
                     UNIQUE(room_code, user_id)
                 )
             ''')
-        
-            # 6. 創建新表結構（包含room_code）
+
             c.execute('''
-                CREATE TABLE todos_new (
+                CREATE TABLE IF NOT EXISTS todos (
                     id SERIAL PRIMARY KEY, 
                     room_code TEXT DEFAULT 'default_room',
                     user_id BIGINT, 
@@ -428,531 +610,610 @@ def migrate_database():
                     FOREIGN KEY(room_code) REFERENCES rooms(room_code)
                 )
             ''')
-        
-            # 7. 創建默認房間用於遷移數據
-            c.execute("""
-                INSERT INTO rooms (room_code, room_name, password, owner_id)
-                VALUES ('default_room', '默認房間', %s, 0)
-                ON CONFLICT (room_code) DO NOTHING
-            """, (hash_password('default'),))
-        
-            # 8. 遷移數據 - 明確指定列名
+
+            # 提醒表：重啟後據此恢復未觸發的提醒；刪除待辦時一併刪除
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS reminders (
+                    id SERIAL PRIMARY KEY,
+                    todo_id INTEGER NOT NULL REFERENCES todos(id) ON DELETE CASCADE,
+                    fire_at TIMESTAMPTZ NOT NULL,
+                    fired BOOLEAN NOT NULL DEFAULT FALSE,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # 類別排序鍵：舊數據按原來的 CASE 順序回填
+            c.execute("ALTER TABLE todos ADD COLUMN IF NOT EXISTS category_order SMALLINT")
             c.execute("""
-                INSERT INTO todos_new (user_id, category, task, created_at)
-                SELECT user_id, category, task, created_at FROM todos
+                UPDATE todos SET category_order = CASE category
+                    WHEN 'game' THEN 1
+                    WHEN 'movie' THEN 2
+                    WHEN 'action' THEN 3
+                    ELSE 4
+                END
+                WHERE category_order IS NULL
             """)
-        
-            # 9. 刪除舊表並重命名新表
-            c.execute("DROP TABLE todos")
-            c.execute("ALTER TABLE todos_new RENAME TO todos")
-        
-            logger.info("數據庫遷移完成")
-        else:
-            logger.info("數據庫結構已是最新")
-        
-        conn.commit()
-    
-    except Exception as e:
-        logger.error(f"數據庫遷移失敗: {e}")
-        conn.rollback()
-        # 不要重新拋出異常，讓應用繼續啟動
-        logger.info("數據庫遷移失敗，但繼續啟動應用")
-    finally:
-        put_db_connection(conn)
 
-# Database functions
-def init_db():
-    """初始化數據庫"""
-    conn = get_db_connection()
-    try:
-        c = conn.cursor()
-    
-        # 創建用戶表（必須最先創建）
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY, 
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-    
-        # 創建其他必要的表
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS rooms (
-                room_code TEXT PRIMARY KEY,
-                room_name TEXT,
-                password TEXT,
-                owner_id BIGINT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS room_members (
-                id SERIAL PRIMARY KEY,
-                room_code TEXT,
-                user_id BIGINT,
-                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(room_code) REFERENCES rooms(room_code),
-                UNIQUE(room_code, user_id)
-            )
-        ''')
-        
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS todos (
-                id SERIAL PRIMARY KEY, 
-                room_code TEXT DEFAULT 'default_room',
-                user_id BIGINT, 
-                category TEXT,
-                task TEXT, 
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(room_code) REFERENCES rooms(room_code)
-            )
-        ''')
-        
-        # 創建默認房間
-        c.execute("""
-            INSERT INTO rooms (room_code, room_name, password, owner_id)
-            VALUES ('default_room', '默認房間', %s, 0)
-            ON CONFLICT (room_code) DO NOTHING
-        """, (hash_password('default'),))
-    
-        conn.commit()
+            # 創建查詢索引（room_members(room_code, user_id) 已由 UNIQUE 約束覆蓋）
+            c.execute("DROP INDEX IF EXISTS idx_todos_room_created")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_todos_room_order ON todos(room_code, category_order, created_at)")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_todos_room_cat_created ON todos(room_code, category, created_at)")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_room_members_user ON room_members(user_id, joined_at DESC)")
+            # 啟動時只掃描未觸發的提醒；部分索引不包含已發出的歷史記錄
+            c.execute("CREATE INDEX IF NOT EXISTS idx_reminders_pending ON reminders(fire_at) WHERE NOT fired")
+
+            # 創建默認房間
+            ensure_default_room(c)
+
         logger.info("數據庫表初始化成功")
-    
-        # 暫時跳過遷移邏輯，因為是新數據庫
-        # migrate_database()
-        logger.info("跳過數據庫遷移（新數據庫）")
-    
+
     except Exception as e:
-        logger.critical(f"數據庫初始化失敗: {e}")
+        logger.critical("數據庫初始化失敗: %s", e)
         # 不要重新拋出異常，讓應用可以繼續啟動
         logger.info("數據庫初始化遇到問題，但嘗試繼續啟動應用")
-    finally:
-        put_db_connection(conn)
 
-def add_todo_to_db(room_code, user_id, category, task, context: ContextTypes.DEFAULT_TYPE = None):
-    conn = get_db_connection()
+def add_todo_to_db(room_code, user_id, category, task):
     try:
-        c = conn.cursor()
-    
-        # 確保用戶存在
-        c.execute("""
-            INSERT INTO users (user_id) 
-            VALUES (%s)
-            ON CONFLICT (user_id) DO NOTHING
-        """, (user_id,))
-    
-        # 確保房間存在
-        c.execute("SELECT 1 FROM rooms WHERE room_code = %s", (room_code,))
-        room_exists = c.fetchone()
-    
-        if not room_exists:
-            return None
-    
-        # 檢查用戶是否在房間中
-        c.execute("SELECT 1 FROM room_members WHERE room_code = %s AND user_id = %s", (room_code, user_id))
-        if not c.fetchone():
-            return None
-    
-        # 添加待辦
-        c.execute("""
-            INSERT INTO todos (room_code, user_id, category, task) 
-            VALUES (%s, %s, %s, %s)
-            RETURNING id
-        """, (room_code, user_id, category, task))
-    
-        todo_id = c.fetchone()[0]
-        conn.commit()
-    
-        # 發送通知
-        if context:
-            asyncio.create_task(notify_room_members(
-                room_code, 
-                f"📝 新待辦事項添加：\n{task}\n類別：{CATEGORIES.get(category, '未知')}",
-                context
-            ))
-    
-        return todo_id
-    
+        with db_cursor() as c:
+            # 確保用戶存在、檢查成員資格並添加待辦，一次往返完成
+            # （成員資格成立即代表房間存在）
+            execute_prepared(c, "add_todo", """
+                WITH u AS (
+                    INSERT INTO users (user_id)
+                    VALUES ($2::bigint)
+                    ON CONFLICT (user_id) DO NOTHING
+                ), m AS (
+                    SELECT 1 FROM room_members
+                    WHERE room_code = $1::text AND user_id = $2::bigint
+                )
+                INSERT INTO todos (room_code, user_id, category, task, category_order)
+                SELECT $1::text, $2::bigint, $3::text, $4::text, $5::smallint
+                WHERE EXISTS (SELECT 1 FROM m)
+                RETURNING id
+            """, (room_code, user_id, category, task,
+                  CATEGORY_ORDER.get(category, CATEGORY_ORDER_OTHER)))
+
+            row = c.fetchone()
+            return row[0] if row else None
+
     except Exception as e:
-        logger.error(f"添加待辦失敗: {e}")
-        conn.rollback()
+        logger.error("添加待辦失敗: %s", e)
         return None
-    finally:
-        put_db_connection(conn)
 
-def get_todos(room_code, category=None):
-    conn = get_db_connection()
+def add_todos_to_db(room_code, user_id, category, tasks):
+    """批量添加同一类别的多条待办，一条 INSERT 完成；不在房间中时返回空列表"""
     try:
-        c = conn.cursor()
-    
-        # 确保房间存在
-        c.execute("SELECT 1 FROM rooms WHERE room_code = %s", (room_code,))
-        if not c.fetchone():
-            return []  # 房间不存在，返回空列表
-        
-        if category:
-            c.execute("""
-                SELECT id, user_id, category, task, created_at
-                FROM todos 
-                WHERE room_code = %s AND category = %s 
-                ORDER BY 
-                    CASE category
-                        WHEN 'game' THEN 1
-                        WHEN 'movie' THEN 2
-                        WHEN 'action' THEN 3
-                        ELSE 4
-                    END,
-                    created_at
-            """, (room_code, category))
-        else:
-            c.execute("""
-                SELECT id, user_id, category, task, created_at
-                FROM todos 
-                WHERE room_code = %s 
-                ORDER BY 
-                    CASE category
-                        WHEN 'game' THEN 1
-                        WHEN 'movie' THEN 2
-                        WHEN 'action' THEN 3
-                        ELSE 4
-                    END,
-                    created_at
-            """, (room_code,))
-        
-        todos = c.fetchall()
-        return todos
-    
+        with db_cursor() as c:
+            execute_prepared(c, "add_todos", """
+                WITH u AS (
+                    INSERT INTO users (user_id)
+                    VALUES ($2::bigint)
+                    ON CONFLICT (user_id) DO NOTHING
+                ), m AS (
+                    SELECT 1 FROM room_members
+                    WHERE room_code = $1::text AND user_id = $2::bigint
+                )
+                INSERT INTO todos (room_code, user_id, category, task, category_order)
+                SELECT $1::text, $2::bigint, $3::text, t.task, $5::smallint
+                FROM unnest($4::text[]) WITH ORDINALITY AS t(task, n)
+                WHERE EXISTS (SELECT 1 FROM m)
+                ORDER BY t.n
+                RETURNING id
+            """, (room_code, user_id, category, list(tasks),
+                  CATEGORY_ORDER.get(category, CATEGORY_ORDER_OTHER)))
+            return [row[0] for row in c.fetchall()]
+
     except Exception as e:
-        logger.error(f"查询待办失败: {e}")
+        logger.error("批量添加待辦失敗: %s", e)
         return []
-    finally:
-        put_db_connection(conn)
-
 
-def delete_todo(room_code, todo_id, context: ContextTypes.DEFAULT_TYPE = None):
-    conn = get_db_connection()
+def get_member_todo(todo_id, user_id):
+    """取待办的房间、类别和内容；仅当该用户是所在房间成员时返回，否则返回 None"""
     try:
-        c = conn.cursor()
-      
-        # 先获取待办信息用于通知
-        c.execute("SELECT task FROM todos WHERE id = %s AND room_code = %s", (todo_id, room_code))
-        result = c.fetchone()
-      
-        if not result:
-            return False
-      
-        task = result[0]
-      
-        # 删除待办
-        c.execute("""
-            DELETE FROM todos 
-            WHERE id = %s AND room_code = %s
-        """, (todo_id, room_code))
-      
-        conn.commit()
-        success = c.rowcount > 0
-      
-        # 发送通知（如果删除成功且提供了context）
-        if success and context:
-            asyncio.create_task(notify_room_members(
-                room_code, 
-                f"🗑️ 待辦事項已刪除：\n{task}",
-                context
-            ))
-      
-        return success
+        with db_cursor() as c:
+            execute_prepared(c, "get_member_todo", """
+                SELECT t.room_code, t.category, t.task
+                FROM todos t
+                JOIN room_members rm ON rm.room_code = t.room_code AND rm.user_id = $2
+                WHERE t.id = $1
+            """, (todo_id, user_id))
+            row = c.fetchone()
+        if not row:
+            return None
+        room_code, category, task = row
+        return {'room_code': room_code, 'category': category, 'task': task}
     except Exception as e:
-        logger.error(f"Error deleting todo: {e}")
-        conn.rollback()
-        return False
-    finally:
-        put_db_connection(conn)
+        logger.error("查询待办失败: %s", e)
+        return None
 
-# Keyboard functions
-def get_main_keyboard():
-    return ReplyKeyboardMarkup([
-        [TEXTS['query_all'], TEXTS['query_category']],
-        [TEXTS['add_todo'], TEXTS['delete_todo']],
-        [TEXTS['room_options']],
-        [TEXTS['help']]
-    ], resize_keyboard=True, one_time_keyboard=False)
-
-def get_room_options_keyboard():
-    """房间选项二级菜单"""
-    return ReplyKeyboardMarkup([
-        [TEXTS['create_room'], TEXTS['join_room']],
-        [TEXTS['leave_room']],
-        ['⬅️ 返回主菜单']
-    ], resize_keyboard=True, one_time_keyboard=False)
-
-def get_category_keyboard(operation_type):
-    keyboard = []
-    for category_id, category_name in CATEGORIES.items():
-        keyboard.append([InlineKeyboardButton(category_name, callback_data=f'{operation_type}_category_{category_id}')])
-    return InlineKeyboardMarkup(keyboard)
+def save_reminder(todo_id, fire_at):
+    """记录一条待触发的提醒，返回提醒 id；失败时返回 None（提醒仍只在内存中生效）"""
+    try:
+        with db_cursor() as c:
+            c.execute("""
+                INSERT INTO reminders (todo_id, fire_at)
+                VALUES (%s, %s)
+                RETURNING id
+            """, (todo_id, fire_at))
+            return c.fetchone()[0]
+    except Exception as e:
+        logger.error("保存提醒失敗: %s", e)
+        return None
 
-def get_delete_keyboard(todos):
-    keyboard = []
-    for todo_id, _, _, task, _ in todos:
-        keyboard.append([InlineKeyboardButton(f"{task[:20]}...", callback_data=f'delete_{todo_id}')])
-    return InlineKeyboardMarkup(keyboard)
+def mark_reminder_fired(reminder_id):
+    """提醒发出后标记，重启时不再恢复"""
+    try:
+        with db_cursor() as c:
+            c.execute("UPDATE reminders SET fired = TRUE WHERE id = %s", (reminder_id,))
+    except Exception as e:
+        logger.error("更新提醒狀態失敗: %s", e)
 
-def get_leave_room_keyboard(rooms):
-    """离开房间的选择键盘"""
-    keyboard = []
-    for room_code, room_name in rooms:
-        keyboard.append([InlineKeyboardButton(f"{room_name} ({room_code})", callback_data=f'leave_{room_code}')])
-    keyboard.append([InlineKeyboardButton('⬅️ 取消', callback_data='cancel_leave')])
-    return InlineKeyboardMarkup(keyboard)
+def load_pending_reminders():
+    """取出所有未触发的提醒及其待办内容"""
+    try:
+        with db_cursor() as c:
+            c.execute("""
+                SELECT r.id, r.todo_id, r.fire_at, t.room_code, t.category, t.task
+                FROM reminders r
+                JOIN todos t ON t.id = r.todo_id
+                WHERE NOT r.fired
+                ORDER BY r.fire_at
+            """)
+            return c.fetchall()
+    except Exception as e:
+        logger.error("讀取待觸發提醒失敗: %s", e)
+        return []
+
+def get_todos(room_code, category=None, page=0, page_size=None):
+    """按页查询房间待办，每页 page_size 条"""
+    if page_size is None:
+        page_size = TODO_PAGE_SIZE
+    try:
+        with db_cursor() as c:
+            # 确保房间存在
+            execute_prepared(c, "room_exists", "SELECT 1 FROM rooms WHERE room_code = $1", (room_code,))
+            if not c.fetchone():
+                return []  # 房间不存在，返回空列表
+
+            if category:
+                execute_prepared(c, "get_todos_cat", """
+                    SELECT id, user_id, category, task, created_at
+                    FROM todos 
+                    WHERE room_code = $1 AND category = $2 
+                    ORDER BY created_at
+                    LIMIT $3 OFFSET $4
+                """, (room_code, category, page_size, page * page_size))
+            else:
+                execute_prepared(c, "get_todos_all", """
+                    SELECT id, user_id, category, task, created_at
+                    FROM todos 
+                    WHERE room_code = $1 
+                    ORDER BY category_order, created_at
+                    LIMIT $2 OFFSET $3
+                """, (room_code, page_size, page * page_size))
+
+            todos = c.fetchall()
+            return todos
+
+    except Exception as e:
+        logger.error("查询待办失败: %s", e)
+        return []
+
+
+def delete_todo(room_code, todo_id):
+    """删除待办，成功时返回被删除的内容，否则返回 None"""
+    try:
+        with db_cursor() as c:
+            # 删除待办，同时取回内容用于通知
+            execute_prepared(c, "delete_todo", """
+                DELETE FROM todos 
+                WHERE id = $1 AND room_code = $2
+                RETURNING task
+            """, (todo_id, room_code))
+            result = c.fetchone()
 
-def get_reminder_keyboard():
+            return result[0] if result else None
+    except Exception as e:
+        logger.error("Error deleting todo: %s", e)
+        return None
+
+# Keyboard functions
+# 固定菜单在导入时构建一次，之后每条消息直接复用
+_MAIN_KB = ReplyKeyboardMarkup([
+    [TEXTS['query_all'], TEXTS['query_category']],
+    [TEXTS['add_todo'], TEXTS['delete_todo']],
+    [TEXTS['room_options']],
+    [TEXTS['help']]
+], resize_keyboard=True, one_time_keyboard=False)
+
+_ROOM_OPTS_KB = ReplyKeyboardMarkup([
+    [TEXTS['create_room'], TEXTS['join_room']],
+    [TEXTS['leave_room']],
+    ['⬅️ 返回主菜单']
+], resize_keyboard=True, one_time_keyboard=False)
+
+_CATEGORY_KB = {
+    op: InlineKeyboardMarkup([
+        [InlineKeyboardButton(name, callback_data=f'{op}_category_{cid}')]
+        for cid, name in CATEGORY_ITEMS
+    ])
+    for op in ('add', 'query')
+}
+
+# 提醒流程的 callback_data 自带待办 id 和日期，不依赖 user_data，机器人重启后按钮仍然有效
+def get_reminder_keyboard(todo_id):
     """提醒选择键盘"""
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton(TEXTS['create_reminder'], callback_data='set_reminder')],
+        [InlineKeyboardButton(TEXTS['create_reminder'], callback_data=f'set_reminder_{todo_id}')],
         [InlineKeyboardButton(TEXTS['skip_reminder'], callback_data='skip_reminder')]
     ])
 
-def create_calendar_keyboard(year=None, month=None):
+def _next_page_row(page, todos, callback_prefix):
+    """本页已满时返回下一页按钮所在的行，否则返回 None"""
+    if len(todos) < TODO_PAGE_SIZE:
+        return None
+    return [InlineKeyboardButton(TEXTS['next_page'], callback_data=f'{callback_prefix}_{page + 1}')]
+
+def get_todos_page_keyboard(page, todos, callback_prefix='page'):
+    """本页已满时提供下一页按钮"""
+    row = _next_page_row(page, todos, callback_prefix)
+    return InlineKeyboardMarkup([row]) if row else None
+
+def _button_label(task, limit=20):
+    """只在超长时截断并加省略号"""
+    return task if len(task) <= limit else task[:limit] + '…'
+
+def get_delete_keyboard(todos, page=0):
+    keyboard = [
+        [InlineKeyboardButton(_button_label(task), callback_data=f'delete_{todo_id}')]
+        for todo_id, _, _, task, _ in todos
+    ]
+    row = _next_page_row(page, todos, 'dpage')
+    if row:
+        keyboard.append(row)
+    return InlineKeyboardMarkup(keyboard)
+
+def get_leave_room_keyboard(rooms):
+    """离开房间的选择键盘"""
+    keyboard = []
+    for room_code, room_name in rooms:
+        keyboard.append([InlineKeyboardButton(f"{room_name} ({room_code})", callback_data=f'leave_{room_code}')])
+    keyboard.append([InlineKeyboardButton('⬅️ 取消', callback_data='cancel_leave')])
+    return InlineKeyboardMarkup(keyboard)
+
+def create_calendar_keyboard(todo_id, year=None, month=None):
     """创建日历键盘"""
     now = datetime.now()
     if year is None:
         year = now.year
     if month is None:
         month = now.month
-    
-    keyboard = []
-    # 第一行 - 月份和年份
-    row = [InlineKeyboardButton(f"{calendar.month_name[month]} {year}", callback_data="CAL_IGNORE")]
-    keyboard.append(row)
-    
-    # 第二行 - 星期
-    row = []
-    for day in ["Mo", "Tu", "We", "Th", "Fr", "Sa", "Su"]:
-        row.append(InlineKeyboardButton(day, callback_data="CAL_IGNORE"))
-    keyboard.append(row)
-    
+    return _calendar_kb(year, month, todo_id)
+
+# 日历里不变的星期行和空白格
+_WEEKDAY_ROW = tuple(InlineKeyboardButton(day, callback_data="CAL_IGNORE")
+                     for day in ("Mo", "Tu", "We", "Th", "Fr", "Sa", "Su"))
+_BLANK_DAY = InlineKeyboardButton(" ", callback_data="CAL_IGNORE")
+
+@lru_cache(maxsize=256)
+def _month_layout(year, month):
+    """按 (年, 月) 缓存与待办无关的部分：标题行、日期网格和前后月份，各待办共用"""
+    title_row = (InlineKeyboardButton(f"{calendar.month_name[month]} {year}", callback_data="CAL_IGNORE"),)
+    weeks = tuple(tuple(week) for week in calendar.monthcalendar(year, month))
+    prev_month = date(year, month, 1) - timedelta(days=1)
+    next_month = date(year, month, 28) + timedelta(days=4)  # 确保进入下个月
+    return title_row, weeks, (prev_month.year, prev_month.month), (next_month.year, next_month.month)
+
+def _calendar_kb(year, month, todo_id):
+    """构建某月的日历键盘；按钮里带着待办 id，只有月份布局可以缓存"""
+    title_row, weeks, (prev_year, prev_mon), (next_year, next_mon) = _month_layout(year, month)
+    # 第一行 - 月份和年份，第二行 - 星期
+    keyboard = [title_row, _WEEKDAY_ROW]
+
     # 日历日期
-    my_calendar = calendar.monthcalendar(year, month)
-    for week in my_calendar:
-        row = []
-        for day in week:
-            if day == 0:
-                row.append(InlineKeyboardButton(" ", callback_data="CAL_IGNORE"))
-            else:
-                callback_data = f"CAL_DAY_{year}_{month}_{day}"
-                row.append(InlineKeyboardButton(str(day), callback_data=callback_data))
-        keyboard.append(row)
-    
+    keyboard.extend(
+        [_BLANK_DAY if day == 0
+         else InlineKeyboardButton(str(day), callback_data=f"CAL_DAY_{year}_{month}_{day}_{todo_id}")
+         for day in week]
+        for week in weeks
+    )
+
     # 导航行
-    row = []
-    prev_month = datetime(year, month, 1) - timedelta(days=1)
-    next_month = datetime(year, month, 28) + timedelta(days=4)  # 确保进入下个月
-    
-    row.append(InlineKeyboardButton("<", callback_data=f"CAL_PREV_{prev_month.year}_{prev_month.month}"))
-    row.append(InlineKeyboardButton(" ", callback_data="CAL_IGNORE"))
-    row.append(InlineKeyboardButton(">", callback_data=f"CAL_NEXT_{next_month.year}_{next_month.month}"))
-    keyboard.append(row)
-    
-    return InlineKeyboardMarkup(keyboard)
+    keyboard.append([
+        InlineKeyboardButton("<", callback_data=f"CAL_PREV_{prev_year}_{prev_mon}_{todo_id}"),
+        _BLANK_DAY,
+        InlineKeyboardButton(">", callback_data=f"CAL_NEXT_{next_year}_{next_mon}_{todo_id}"),
+    ])
 
-def create_time_selection_keyboard():
-    """创建时间选择键盘"""
-    keyboard = []
-    
-    # 小时行
-    hours_row = []
-    for hour in [9, 10, 11, 12]:
-        hours_row.append(InlineKeyboardButton(f"{hour:02d}:00", callback_data=f"TIME_{hour:02d}_00"))
-    keyboard.append(hours_row)
-    
-    hours_row = []
-    for hour in [13, 14, 15, 16]:
-        hours_row.append(InlineKeyboardButton(f"{hour:02d}:00", callback_data=f"TIME_{hour:02d}_00"))
-    keyboard.append(hours_row)
-    
-    hours_row = []
-    for hour in [17, 18, 19, 20]:
-        hours_row.append(InlineKeyboardButton(f"{hour:02d}:00", callback_data=f"TIME_{hour:02d}_00"))
-    keyboard.append(hours_row)
-    
-    # 自定义时间行
-    keyboard.append([InlineKeyboardButton("自定义时间", callback_data="CUSTOM_TIME")])
-    
     return InlineKeyboardMarkup(keyboard)
 
+# 预设时间按钮的小时分组
+_TIME_ROWS = ((9, 10, 11, 12), (13, 14, 15, 16), (17, 18, 19, 20))
+
+def get_time_keyboard(reminder_date, todo_id):
+    """时间选择键盘，日期以 YYYYMMDD 编码在 callback_data 中"""
+    suffix = f"{reminder_date:%Y%m%d}_{todo_id}"
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"{hour:02d}:00", callback_data=f"TIME_{hour:02d}_00_{suffix}") for hour in hours]
+        for hours in _TIME_ROWS
+    ] + [
+        # 自定义时间行
+        [InlineKeyboardButton("自定义时间", callback_data=f"CUSTOM_TIME_{suffix}")]
+    ])
+
+def parse_date_token(token):
+    """解析 callback_data 中的 YYYYMMDD 日期，格式不对时抛出 ValueError"""
+    if len(token) != 8 or not token.isdigit():
+        raise ValueError(token)
+    return date(int(token[:4]), int(token[4:6]), int(token[6:8]))
+
 # Handlers
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         TEXTS['welcome'],
-        reply_markup=get_main_keyboard()
+        reply_markup=_MAIN_KB
     )
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         TEXTS['help_text'],
-        reply_markup=get_main_keyboard()
+        reply_markup=_MAIN_KB
     )
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-    message_text = update.message.text
+# 文本消息处理 - 各分支拆成独立函数，由下方的分派表查找
+# 自定义时间的输入格式：H:MM 或 HH:MM（也接受一位分钟），只认 ASCII 数字
+_HHMM_RE = re.compile(r'(\d{1,2}):(\d{1,2})', re.ASCII)
+
+def parse_hhmm(text):
+    """校验并解析用户输入的 HH:MM，格式不对时返回 None"""
+    m = _HHMM_RE.fullmatch(text.strip())
+    if not m:
+        return None
+    hour, minute = int(m[1]), int(m[2])
+    if hour > 23 or minute > 59:
+        return None
+    return hour, minute
+
+async def _h_custom_time(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
+    # 处理自定义时间输入：先显式校验，正常路径不依赖异常
+    parsed_time = parse_hhmm(update.message.text)
+    if parsed_time is None:
+        await update.message.reply_text("❌ 時間格式錯誤，請使用 HH:MM 格式")
+        return
+    hour, minute = parsed_time
+    
+    reminder = context.user_data.get('reminder') or {}
+    reminder_date = reminder.get('date')
+    
+    todo_info = None
+    if reminder_date and 'todo_id' in reminder:
+        todo_info = await asyncio.to_thread(get_member_todo, reminder['todo_id'], user_id)
+    if not todo_info:
+        context.user_data.pop('reminder', None)
+        context.user_data.pop('state', None)
+        await update.message.reply_text("設置失敗，請重新嘗試")
+        return
     
-    # 首先检查自定义日期和时间的输入
-    if 'waiting_custom_date' in context.user_data:
-        # 处理自定义日期输入
-        try:
-            date_str = update.message.text
-            datetime.strptime(date_str, "%Y-%m-%d")  # 验证日期格式
-            context.user_data['reminder_date'] = date_str
-            context.user_data.pop('waiting_custom_date')
-            await update.message.reply_text(
-                TEXTS['select_time'],
-                reply_markup=create_time_selection_keyboard()
-            )
-        except ValueError:
-            await update.message.reply_text("❌ 日期格式錯誤，請使用 YYYY-MM-DD 格式")
+    # 组合日期和时间
+    reminder_datetime = datetime(reminder_date.year, reminder_date.month, reminder_date.day, hour, minute)
+    
+    if reminder_datetime <= datetime.now():
+        await update.message.reply_text(
+            "❌ 不能設置過去的時間作為提醒",
+            reply_markup=_MAIN_KB
+        )
         return
     
-    elif 'waiting_custom_time' in context.user_data:
-        # 处理自定义时间输入
-        try:
-            time_str = update.message.text
-            datetime.strptime(time_str, "%H:%M")  # 验证时间格式
-            date_str = context.user_data.get('reminder_date')
-            
-            if not date_str or 'last_todo' not in context.user_data:
-                await update.message.reply_text("設置失敗，請重新嘗試")
-                return
-            
-            # 解析日期和时间
-            reminder_datetime = datetime.strptime(f"{date_str} {time_str}", "%Y-%m-%d %H:%M")
-            now = datetime.now()
-            
-            if reminder_datetime <= now:
-                await update.message.reply_text(
-                    "❌ 不能設置過去的時間作為提醒",
-                    reply_markup=get_main_keyboard()
-                )
-                return
-            
-            # 计算延迟时间（秒）
-            delay = (reminder_datetime - now).total_seconds()
-            
-            # 获取待办信息
-            todo_info = context.user_data['last_todo']
-            
-            # 安排提醒任务
-            context.job_queue.run_once(
-                send_reminder, 
-                delay, 
-                data={
-                    'room_code': todo_info['room_code'],
-                    'task': todo_info['task'],
-                    'category': todo_info['category']
-                }
-            )
-            
-            await update.message.reply_text(
-                TEXTS['reminder_set'].format(reminder_datetime.strftime("%Y-%m-%d %H:%M")),
-                reply_markup=get_main_keyboard()
-            )
-            
-            # 清理用户数据
-            context.user_data.pop('last_todo', None)
-            context.user_data.pop('reminder_date', None)
-            context.user_data.pop('waiting_custom_time', None)
-            
-        except ValueError:
-            await update.message.reply_text("❌ 時間格式錯誤，請使用 HH:MM 格式")
+    # 提醒落库并建好任务后再回复，避免告知成功后才发现待办已被删除
+    if not await schedule_reminder(context, reminder['todo_id'], todo_info, reminder_datetime):
+        await update.message.reply_text("❌ 設置失敗，請重新嘗試", reply_markup=_MAIN_KB)
+        context.user_data.pop('reminder', None)
+        context.user_data.pop('state', None)
         return
+    
+    await update.message.reply_text(
+        TEXTS['reminder_set'].format(reminder_datetime.strftime("%Y-%m-%d %H:%M")),
+        reply_markup=_MAIN_KB
+    )
+    
+    # 清理用户数据
+    context.user_data.pop('reminder', None)
+    context.user_data.pop('state', None)
 
-    # 房间管理功能
-    if message_text == TEXTS['room_options']:
+async def _h_room_options(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
+    await update.message.reply_text(
+        "🏠 房間管理選項",
+        reply_markup=_ROOM_OPTS_KB
+    )
+
+async def _h_create_room(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
+    context.user_data['state'] = S.WAIT_ROOM_NAME
+    await update.message.reply_text(TEXTS['enter_room_name'])
+
+async def _h_join_room(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
+    context.user_data['state'] = S.WAIT_ROOM_CODE
+    await update.message.reply_text(TEXTS['enter_room_code'])
+
+async def _h_leave_room(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
+    rooms = await asyncio.to_thread(get_user_rooms, user_id)
+    if not rooms:
         await update.message.reply_text(
-            "🏠 房間管理選項",
-            reply_markup=get_room_options_keyboard()
+            TEXTS['no_rooms_joined'],
+            reply_markup=_MAIN_KB
         )
         return
-  
-    elif message_text == TEXTS['create_room']:
-        context.user_data['waiting_room_name'] = True
-        await update.message.reply_text(TEXTS['enter_room_name'])
-        return
-  
-    elif message_text == TEXTS['join_room']:
-        context.user_data['waiting_room_code'] = True
-        await update.message.reply_text(TEXTS['enter_room_code'])
-        return
-  
-    elif message_text == TEXTS['leave_room']:
-        rooms = get_user_rooms(user_id)
-        if not rooms:
-            await update.message.reply_text(
-                TEXTS['no_rooms_joined'],
-                reply_markup=get_main_keyboard()
-            )
-            return
-        
+    
+    await update.message.reply_text(
+        TEXTS['choose_room_to_leave'],
+        reply_markup=get_leave_room_keyboard(rooms)
+    )
+
+async def _h_back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
+    await update.message.reply_text(
+        "返回主菜单",
+        reply_markup=_MAIN_KB
+    )
+
+async def _h_room_name(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
+    context.user_data['room_name'] = update.message.text
+    context.user_data['state'] = S.WAIT_ROOM_PW
+    await update.message.reply_text(TEXTS['enter_room_password'])
+
+async def _h_room_password(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
+    room_name = context.user_data['room_name']
+    password = update.message.text
+    room_code = await asyncio.to_thread(create_room, room_name, password, user_id)
+    context.user_data.clear()
+    await update.message.reply_text(
+        TEXTS['room_created'].format(room_code),
+        reply_markup=_MAIN_KB
+    )
+
+async def _h_room_code(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
+    context.user_data['room_code'] = update.message.text
+    context.user_data['state'] = S.WAIT_JOIN_PW
+    await update.message.reply_text(TEXTS['enter_join_password'])
+
+async def _h_join_password(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
+    room_code = context.user_data['room_code']
+    password = update.message.text
+    success, message = await asyncio.to_thread(join_room, room_code, password, user_id)
+    context.user_data.clear()
+    
+    if success:
         await update.message.reply_text(
-            TEXTS['choose_room_to_leave'],
-            reply_markup=get_leave_room_keyboard(rooms)
+            TEXTS['join_success'].format(message),
+            reply_markup=_MAIN_KB
         )
-        return
-  
-    elif message_text == '⬅️ 返回主菜单':
+    else:
         await update.message.reply_text(
-            "返回主菜单",
-            reply_markup=get_main_keyboard()
+            TEXTS['join_failed'].format(message),
+            reply_markup=_MAIN_KB
         )
-        return
-  
-    elif 'waiting_room_name' in context.user_data:
-        context.user_data['room_name'] = message_text
-        context.user_data['waiting_room_password'] = True
-        context.user_data.pop('waiting_room_name')
-        await update.message.reply_text(TEXTS['enter_room_password'])
-        return
-  
-    elif 'waiting_room_password' in context.user_data:
-        room_name = context.user_data['room_name']
-        password = message_text
-        room_code = create_room(room_name, password, user_id)
-        context.user_data.clear()
+
+async def _add_many(update, context, user_id, current_room, category, tasks):
+    """批量添加多条待办；批量添加时不逐条询问提醒"""
+    try:
+        todo_ids = await asyncio.to_thread(add_todos_to_db, current_room, user_id, category, tasks)
+    except Exception as e:
+        logger.error("批量添加待辦失敗: %s", e)
+        todo_ids = []
+    if not todo_ids:
         await update.message.reply_text(
-            TEXTS['room_created'].format(room_code),
-            reply_markup=get_main_keyboard()
+            "❌ 添加失敗，請確認您仍在該房間中",
+            reply_markup=_MAIN_KB
         )
         return
-    
-    elif 'waiting_room_code' in context.user_data:
-        context.user_data['room_code'] = message_text
-        context.user_data['waiting_join_password'] = True
-        context.user_data.pop('waiting_room_code')
-        await update.message.reply_text(TEXTS['enter_join_password'])
+    bump_room_version(current_room)
+    category_name = CATEGORIES.get(category, '未知')
+    lines = "\n".join(f"- {t}" for t in tasks)[:MAX_MESSAGE_CHARS]
+    spawn_background(notify_room_members(
+        current_room,
+        f"📝 新待辦事項添加（{len(todo_ids)} 項）：\n{lines}\n類別：{category_name}",
+        context,
+        user_id
+    ))
+    await update.message.reply_text(
+        f"✅ 已添加 {len(todo_ids)} 項待辦事項",
+        reply_markup=_MAIN_KB
+    )
+
+async def _h_task(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id, current_room):
+    category = context.user_data['waiting_category']
+    task = update.message.text
+    # 多行输入视为多条待办，一次写入
+    tasks = [line.strip() for line in task.splitlines() if line.strip()]
+    if len(tasks) > 1:
+        try:
+            await _add_many(update, context, user_id, current_room, category, tasks)
+        finally:
+            context.user_data.pop('state', None)
+            context.user_data.pop('waiting_category', None)
         return
-    
-    elif 'waiting_join_password' in context.user_data:
-        room_code = context.user_data['room_code']
-        password = message_text
-        success, message = join_room(room_code, password, user_id)
-        context.user_data.clear()
-        
-        if success:
+    try:
+        todo_id = await asyncio.to_thread(add_todo_to_db, current_room, user_id, category, task)
+        if todo_id:
+            bump_room_version(current_room)
+            # 通知房间其他成员
+            spawn_background(notify_room_members(
+                current_room,
+                f"📝 新待辦事項添加：\n{task}\n類別：{CATEGORIES.get(category, '未知')}",
+                context,
+                user_id
+            ))
             await update.message.reply_text(
-                TEXTS['join_success'].format(message),
-                reply_markup=get_main_keyboard()
+                TEXTS['ask_reminder'],
+                reply_markup=get_reminder_keyboard(todo_id)
             )
         else:
             await update.message.reply_text(
-                TEXTS['join_failed'].format(message),
-                reply_markup=get_main_keyboard()
+                "❌ 添加失敗，請確認您仍在該房間中",
+                reply_markup=_MAIN_KB
             )
-        return
+    except Exception as e:
+        logger.error("添加待辦失敗: %s", e)
+        await update.message.reply_text(
+            "❌ 添加失敗，請稍後重試",
+            reply_markup=_MAIN_KB
+        )
+    finally:
+        context.user_data.pop('state', None)
+        context.user_data.pop('waiting_category', None)
+
+# 优先于菜单按钮处理的输入状态
+PRIORITY_STATE_HANDLERS = {
+    S.WAIT_CUSTOM_TIME: _h_custom_time,
+}
+
+# 房间菜单按钮
+MENU_HANDLERS = {
+    TEXTS['room_options']: _h_room_options,
+    TEXTS['create_room']: _h_create_room,
+    TEXTS['join_room']: _h_join_room,
+    TEXTS['leave_room']: _h_leave_room,
+    '⬅️ 返回主菜单': _h_back_to_main,
+}
+
+# 房间创建/加入流程中的输入状态
+STATE_HANDLERS = {
+    S.WAIT_ROOM_NAME: _h_room_name,
+    S.WAIT_ROOM_PW: _h_room_password,
+    S.WAIT_ROOM_CODE: _h_room_code,
+    S.WAIT_JOIN_PW: _h_join_password,
+}
+
+# 需要当前房间的待办按钮
+TODO_HANDLERS = {
+    TEXTS['query_all']: lambda update, context, room_code: query_all_todos(update, context, room_code),
+    TEXTS['query_category']: lambda update, context, room_code: choose_category(update, context, 'query'),
+    TEXTS['add_todo']: lambda update, context, room_code: choose_category(update, context, 'add'),
+    TEXTS['delete_todo']: lambda update, context, room_code: choose_delete(update, context, room_code),
+    TEXTS['help']: lambda update, context, room_code: help_command(update, context),
+}
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    message_text = update.message.text
+    
+    state = context.user_data.get('state', S.IDLE)
+    
+    # 首先检查自定义日期和时间的输入
+    handler = PRIORITY_STATE_HANDLERS.get(state)
+    if handler:
+        return await handler(update, context, user_id)
+
+    # 房间管理功能
+    handler = MENU_HANDLERS.get(message_text)
+    if handler:
+        return await handler(update, context, user_id)
+
+    handler = STATE_HANDLERS.get(state)
+    if handler:
+        return await handler(update, context, user_id)
     
     # 待办事项功能 - 需要选择当前操作的房间
-    if message_text in [TEXTS['query_all'], TEXTS['query_category'], TEXTS['add_todo'], TEXTS['delete_todo']]:
-        rooms = get_user_rooms(user_id)
+    if message_text in _TODO_ACTIONS:
+        rooms = await asyncio.to_thread(get_user_rooms, user_id)
         if not rooms:
             await update.message.reply_text(TEXTS['not_in_room'])
             return
@@ -973,55 +1234,21 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(TEXTS['not_in_room'])
         return
     
-    if message_text == TEXTS['query_all']:
-        await query_all_todos(update, context, current_room)
-    elif message_text == TEXTS['query_category']:
-        await choose_category(update, context, 'query')
-    elif message_text == TEXTS['add_todo']:
-        await choose_category(update, context, 'add')
-    elif message_text == TEXTS['delete_todo']:
-        await choose_delete(update, context, current_room)
-    elif message_text == TEXTS['help']:
-        await help_command(update, context)
-    else:
-        if 'waiting_task' in context.user_data:
-            category = context.user_data['waiting_category']
-            task = message_text
-            try:
-                todo_id = add_todo_to_db(current_room, user_id, category, task, context)
-                if todo_id:
-                    context.user_data['last_todo'] = {
-                        'id': todo_id,
-                        'category': category,
-                        'task': task,
-                        'room_code': current_room
-                    }
-                    await update.message.reply_text(
-                        TEXTS['ask_reminder'],
-                        reply_markup=get_reminder_keyboard()
-                    )
-                else:
-                    await update.message.reply_text(
-                        "❌ 添加失敗，請確認您仍在該房間中",
-                        reply_markup=get_main_keyboard()
-                    )
-            except Exception as e:
-                logger.error(f"添加待辦失敗: {e}")
-                await update.message.reply_text(
-                    "❌ 添加失敗，請稍後重試",
-                    reply_markup=get_main_keyboard()
-                )
-            finally:
-                context.user_data.pop('waiting_task', None)
-                context.user_data.pop('waiting_category', None)
+    handler = TODO_HANDLERS.get(message_text)
+    if handler:
+        await handler(update, context, current_room)
+    elif state == S.WAIT_TASK:
+        await _h_task(update, context, user_id, current_room)
 
 async def show_room_selection(update, context, rooms, operation):
     """显示房间选择界面"""
     keyboard = []
+    op_id = OP_CODES[operation]
     for room_code, room_name in rooms:
+        callback_data = f'sr{op_id}:{room_code}'
         keyboard.append([InlineKeyboardButton(
             f"{room_name} ({room_code})", 
-            callback_data=f'select_room_{room_code}_{operation.replace(" ", "_")}'
+            callback_data=callback_data
         )])
     
     await update.message.reply_text(
@@ -1029,263 +1256,461 @@ async def show_room_selection(update, context, rooms, operation):
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
-async def callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    user_id = query.from_user.id
-    data = query.data
-    
-    if data.startswith('select_room_'):
-        # 处理房间选择
-        parts = data.split('_')
-        room_code = parts[2]
-        operation = '_'.join(parts[3:]).replace("_", " ")
-        
-        context.user_data['current_room'] = room_code
-        
-        if operation == TEXTS['query_all']:
-            await query_all_todos_from_callback(query, context, room_code)
-        elif operation == TEXTS['query_category']:
-            await choose_category_from_callback(query, context, 'query')
-        elif operation == TEXTS['add_todo']:
-            await choose_category_from_callback(query, context, 'add')
-        elif operation == TEXTS['delete_todo']:
-            await choose_delete_from_callback(query, context, room_code)
+# 选定房间后按操作码直接分派，不再逐个比较菜单文本
+ROOM_OP_HANDLERS = {
+    OP_CODES[TEXTS['query_all']]: lambda query, context, room_code: query_all_todos_from_callback(query, context, room_code),
+    OP_CODES[TEXTS['query_category']]: lambda query, context, room_code: choose_category_from_callback(query, context, 'query'),
+    OP_CODES[TEXTS['add_todo']]: lambda query, context, room_code: choose_category_from_callback(query, context, 'add'),
+    OP_CODES[TEXTS['delete_todo']]: lambda query, context, room_code: choose_delete_from_callback(query, context, room_code),
+}
+
+async def _cb_select_room(query, context, user_id, rest):
+    # 处理房间选择：sr<操作码>:<房间号>
+    handler = ROOM_OP_HANDLERS.get(int(rest[0]))
+    room_code = rest[2:]
     
-    elif data.startswith('add_category_'):
-        category = data.split('_')[2]
-        context.user_data['waiting_category'] = category
-        context.user_data['waiting_task'] = True
-        await query.edit_message_text(TEXTS['enter_task'])
+    context.user_data['current_room'] = room_code
     
-    elif data.startswith('query_category_'):
-        category = data.split('_')[2]
-        room_code = context.user_data.get('current_room')
-        if room_code:
-            await show_todos_by_category(query, context, room_code, category)
-        else:
-            await query.edit_message_text(TEXTS['not_in_room'])
+    if handler:
+        await handler(query, context, room_code)
+
+async def _cb_page(query, context, user_id, rest):
+    # 所有待办的翻页
+    room_code = context.user_data.get('current_room')
+    if room_code:
+        await query_all_todos_from_callback(query, context, room_code, int(rest))
+    else:
+        await query.edit_message_text(TEXTS['not_in_room'])
+
+async def _cb_add_category(query, context, user_id, rest):
+    context.user_data['waiting_category'] = rest
+    context.user_data['state'] = S.WAIT_TASK
+    await query.edit_message_text(TEXTS['enter_task'])
+
+async def _cb_query_category(query, context, user_id, rest):
+    room_code = context.user_data.get('current_room')
+    if room_code:
+        await show_todos_by_category(query, context, room_code, rest)
+    else:
+        await query.edit_message_text(TEXTS['not_in_room'])
+
+async def _cb_category_page(query, context, user_id, rest):
+    # 分类待办的翻页：cpage_<类别>_<页码>
+    category_id, _, page = rest.partition('_')
+    room_code = context.user_data.get('current_room')
+    if room_code:
+        await show_todos_by_category(query, context, room_code, category_id, int(page))
+    else:
+        await query.edit_message_text(TEXTS['not_in_room'])
+
+async def _cb_delete_page(query, context, user_id, rest):
+    # 删除列表的翻页：dpage_<页码>
+    room_code = context.user_data.get('current_room')
+    if room_code:
+        await choose_delete_from_callback(query, context, room_code, int(rest))
+    else:
+        await query.edit_message_text(TEXTS['not_in_room'])
+
+# 以下回调只编辑原消息：edit_message_text 只能附带内联键盘，
+# 底部的回复键盘本身是常驻的，无需再发一条消息重新附上
+async def _cb_delete(query, context, user_id, rest):
+    room_code = context.user_data.get('current_room')
+    if not room_code:
+        await query.edit_message_text(TEXTS['not_in_room'])
+        return
     
-    elif data.startswith('delete_'):
-        room_code = context.user_data.get('current_room')
-        if not room_code:
-            await query.edit_message_text(TEXTS['not_in_room'])
-            return
-        
-        todo_id = int(data.split('_')[1])
-        if delete_todo(room_code, todo_id, context):
-            await query.edit_message_text(TEXTS['task_deleted'])
-        else:
-            await query.edit_message_text("❌ 刪除失敗")
-        
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text="返回主菜单",
-            reply_markup=get_main_keyboard()
-        )
+    todo_id = int(rest)
+    task = await asyncio.to_thread(delete_todo, room_code, todo_id)
+    if task is not None:
+        bump_room_version(room_code)
+        # 已删除的待办不再提醒
+        for job in context.job_queue.get_jobs_by_name(reminder_job_name(todo_id)):
+            job.schedule_removal()
+        spawn_background(notify_room_members(
+            room_code,
+            f"🗑️ 待辦事項已刪除：\n{task}",
+            context,
+            user_id
+        ))
+        await query.edit_message_text(TEXTS['task_deleted'])
+    else:
+        await query.edit_message_text("❌ 刪除失敗")
+
+async def _cb_set_reminder(query, context, user_id, rest):
+    # 用户选择设置提醒：set_reminder_<待办id>
+    # 旧版本留下的按钮格式不同，解析不了就提示重试，而不是抛出异常不回复
+    if not rest.isdigit():
+        await query.edit_message_text("設置失敗，請重新嘗試")
+        return
+    await query.edit_message_text(
+        TEXTS['select_date'],
+        reply_markup=create_calendar_keyboard(int(rest))
+    )
+
+async def _cb_ignore(query, context, user_id, rest):
+    return
+
+async def _cb_cal_day(query, context, user_id, rest):
+    # 用户选择了日期：CAL_DAY_<年>_<月>_<日>_<待办id>
+    try:
+        year, month, day, todo_id = map(int, rest.split('_'))
+        reminder_date = date(year, month, day)
+    except ValueError:
+        await query.edit_message_text("設置失敗，請重新嘗試")
+        return
     
-    elif data == 'set_reminder':
-        # 用户选择设置提醒
-        await query.edit_message_text(
-            TEXTS['select_date'],
-            reply_markup=create_calendar_keyboard()
-        )
+    await query.edit_message_text(
+        TEXTS['select_time'],
+        reply_markup=get_time_keyboard(reminder_date, todo_id)
+    )
+
+async def _cb_cal_month(query, context, user_id, rest):
+    # 切换月份：CAL_PREV/NEXT_<年>_<月>_<待办id>
+    try:
+        year, month, todo_id = map(int, rest.split('_'))
+        if not 1 <= month <= 12:
+            raise ValueError(month)
+    except ValueError:
+        await query.edit_message_text("設置失敗，請重新嘗試")
+        return
+    await query.edit_message_reply_markup(
+        reply_markup=create_calendar_keyboard(todo_id, year, month)
+    )
+
+async def _cb_time(query, context, user_id, rest):
+    # 用户选择了预设时间：TIME_<时>_<分>_<YYYYMMDD>_<待办id>
+    # 日期和时间都来自我们自己的按钮，直接构造，不必经过 strptime；
+    # 旧版本的按钮（如 TIME_09_00）缺少日期和待办，解析失败时提示重试
+    try:
+        hour, minute, date_token, todo_id = rest.split('_')
+        todo_id = int(todo_id)
+        reminder_date = parse_date_token(date_token)
+        reminder_datetime = datetime(reminder_date.year, reminder_date.month, reminder_date.day,
+                                     int(hour), int(minute))
+    except ValueError:
+        await query.edit_message_text("設置失敗，請重新嘗試")
+        return
     
-    elif data.startswith('CAL_'):
-        # 处理日历回调
-        if data == 'CAL_IGNORE':
-            return
-        
-        elif data.startswith('CAL_DAY_'):
-            # 用户选择了日期
-            parts = data.split('_')
-            year, month, day = int(parts[2]), int(parts[3]), int(parts[4])
-            context.user_data['reminder_date'] = f"{year}-{month:02d}-{day:02d}"
-            
-            await query.edit_message_text(
-                TEXTS['select_time'],
-                reply_markup=create_time_selection_keyboard()
-            )
-        
-        elif data.startswith('CAL_PREV_') or data.startswith('CAL_NEXT_'):
-            # 切换月份
-            parts = data.split('_')
-            year, month = int(parts[2]), int(parts[3])
-            await query.edit_message_reply_markup(
-                reply_markup=create_calendar_keyboard(year, month)
-            )
+    todo_info = await asyncio.to_thread(get_member_todo, todo_id, user_id)
+    if not todo_info:
+        await query.edit_message_text("設置失敗，請重新嘗試")
+        return
     
-    elif data.startswith('TIME_'):
-        # 用户选择了预设时间
-        parts = data.split('_')
-        hour, minute = int(parts[1]), int(parts[2])
-        
-        if 'reminder_date' not in context.user_data or 'last_todo' not in context.user_data:
-            await query.edit_message_text("設置失敗，請重新嘗試")
-            return
-        
-        date_str = context.user_data['reminder_date']
-        reminder_datetime = datetime.strptime(f"{date_str} {hour:02d}:{minute:02d}", "%Y-%m-%d %H:%M")
-        now = datetime.now()
-        
-        if reminder_datetime <= now:
-            await query.edit_message_text(
-                "❌ 不能設置過去的時間作為提醒"
-            )
-            return
-        
-        # 计算延迟时间（秒）
-        delay = (reminder_datetime - now).total_seconds()
-        
-        # 获取待办信息
-        todo_info = context.user_data['last_todo']
-        
-        # 安排提醒任务
-        context.job_queue.run_once(
-            send_reminder, 
-            delay, 
-            data={
-                'room_code': todo_info['room_code'],
-                'task': todo_info['task'],
-                'category': todo_info['category']
-            }
-        )
-        
+    if reminder_datetime <= datetime.now():
         await query.edit_message_text(
-            TEXTS['reminder_set'].format(reminder_datetime.strftime("%Y-%m-%d %H:%M"))
+            "❌ 不能設置過去的時間作為提醒"
         )
-        
-        # 清理用户数据
-        context.user_data.pop('last_todo', None)
-        context.user_data.pop('reminder_date', None)
-    
-    elif data == 'CUSTOM_TIME':
-        # 用户选择自定义时间
-        context.user_data['waiting_custom_time'] = True
-        await query.edit_message_text("請輸入時間 (格式: HH:MM，例如 14:30)")
+        return
     
-    elif data == 'skip_reminder':
-        # 用户选择跳过提醒
-        await query.edit_message_text(
-            TEXTS['no_reminder'],
-            reply_markup=get_main_keyboard()
-        )
-        context.user_data.pop('last_todo', None)
+    # 提醒落库并建好任务后再回复，避免告知成功后才发现待办已被删除
+    if not await schedule_reminder(context, todo_id, todo_info, reminder_datetime):
+        await query.edit_message_text("❌ 設置失敗，請重新嘗試")
+        return
     
-    elif data.startswith('leave_'):
-        # 离开房间
-        room_code = data.split('_')[1]
-        success, room_name = leave_room(room_code, user_id)
-        
-        if success:
-            await query.edit_message_text(
-                TEXTS['leave_success'].format(room_name),
-                reply_markup=get_main_keyboard()
-            )
-        else:
-            await query.edit_message_text(
-                TEXTS['leave_failed'],
-                reply_markup=get_main_keyboard()
-            )
+    await query.edit_message_text(
+        TEXTS['reminder_set'].format(reminder_datetime.strftime("%Y-%m-%d %H:%M"))
+    )
+
+async def _cb_custom_time(query, context, user_id, rest):
+    # 用户选择自定义时间：CUSTOM_TIME_<YYYYMMDD>_<待办id>
+    # 接下来是文字输入，只能把日期和待办暂存在 user_data
+    try:
+        date_token, todo_id = rest.split('_')
+        context.user_data['reminder'] = {'date': parse_date_token(date_token), 'todo_id': int(todo_id)}
+    except ValueError:
+        await query.edit_message_text("設置失敗，請重新嘗試")
+        return
+    context.user_data['state'] = S.WAIT_CUSTOM_TIME
+    await query.edit_message_text("請輸入時間 (格式: HH:MM，例如 14:30)")
+
+async def _cb_skip_reminder(query, context, user_id, rest):
+    # 用户选择跳过提醒
+    await query.edit_message_text(TEXTS['no_reminder'])
+
+async def _cb_leave(query, context, user_id, rest):
+    # 离开房间
+    success, room_name = await asyncio.to_thread(leave_room, rest, user_id)
     
-    elif data == 'cancel_leave':
-        # 取消离开房间
-        await query.edit_message_text(
-            "已取消",
-            reply_markup=get_main_keyboard()
+    if success:
+        await query.edit_message_text(TEXTS['leave_success'].format(room_name))
+    else:
+        await query.edit_message_text(TEXTS['leave_failed'])
+
+async def _cb_cancel_leave(query, context, user_id, rest):
+    # 取消离开房间
+    await query.edit_message_text("已取消")
+
+# 完全匹配的回调
+EXACT_CALLBACKS = {
+    'CAL_IGNORE': _cb_ignore,
+    'skip_reminder': _cb_skip_reminder,
+    'cancel_leave': _cb_cancel_leave,
+}
+
+# 按前缀匹配的回调，处理函数收到前缀之后的部分
+CALLBACK_ROUTES = {
+    'page': _cb_page,
+    'cpage': _cb_category_page,
+    'dpage': _cb_delete_page,
+    'add_category': _cb_add_category,
+    'query_category': _cb_query_category,
+    'delete': _cb_delete,
+    'CAL_DAY': _cb_cal_day,
+    'CAL_PREV': _cb_cal_month,
+    'CAL_NEXT': _cb_cal_month,
+    'TIME': _cb_time,
+    'set_reminder': _cb_set_reminder,
+    'CUSTOM_TIME': _cb_custom_time,
+    'leave': _cb_leave,
+}
+
+# 前缀本身含下划线（如 add_category、CAL_DAY）时需要再切一次
+_TWO_PART_PREFIXES = frozenset({'add', 'query', 'CAL', 'set', 'CUSTOM'})
+
+def route_callback(data):
+    """把 callback_data 解析为 (处理函数, 剩余部分)，未知数据的处理函数为 None"""
+    handler = EXACT_CALLBACKS.get(data)
+    if handler:
+        return handler, ''
+    if data.startswith('sr'):
+        return _cb_select_room, data[2:]
+    prefix, _, rest = data.partition('_')
+    if prefix in _TWO_PART_PREFIXES:
+        sub, _, rest = rest.partition('_')
+        prefix = f"{prefix}_{sub}"
+    return CALLBACK_ROUTES.get(prefix), rest
+
+async def callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    # 应答与处理并行进行，不让 answer 的往返阻塞后面的查询和编辑
+    ack = asyncio.create_task(query.answer())
+    try:
+        handler, rest = route_callback(query.data)
+        if handler:
+            await handler(query, context, query.from_user.id, rest)
+    finally:
+        try:
+            await ack
+        except Exception as e:
+            logger.warning("应答回调失败: %s", e)
+
+def reminder_text(category, task):
+    """提醒内容在安排时就拼好，触发时直接发送"""
+    return f"⏰ 提醒：{CATEGORIES.get(category, '未知')} - {task}"
+
+def reminder_job_name(todo_id):
+    """提醒任务按待办命名，删除待办时据此取消"""
+    return f"rem:{todo_id}"
+
+async def schedule_reminder(context: ContextTypes.DEFAULT_TYPE, todo_id, todo_info, when):
+    """在本地时间 when 安排提醒，成功返回 True"""
+    # 直接交给调度器一个带时区的时间点，而不是自行换算成秒数
+    fire_at = when.astimezone()
+    reminder_id = await asyncio.to_thread(save_reminder, todo_id, fire_at)
+    if reminder_id is None:
+        # 保存失败（例如待办刚被删除，外键不成立），不安排任务
+        return False
+    context.job_queue.run_once(
+        send_reminder, 
+        fire_at,
+        name=reminder_job_name(todo_id),
+        data={
+            'reminder_id': reminder_id,
+            'room_code': todo_info['room_code'],
+            'text': reminder_text(todo_info['category'], todo_info['task']),
+        }
+    )
+    return True
+
+async def restore_reminders(application):
+    """启动时从数据库恢复未触发的提醒；停机期间已到时间的立即发送"""
+    rows = await asyncio.to_thread(load_pending_reminders)
+    now = datetime.now().astimezone()
+    for reminder_id, todo_id, fire_at, room_code, category, task in rows:
+        application.job_queue.run_once(
+            send_reminder,
+            max(fire_at, now),
+            name=reminder_job_name(todo_id),
+            data={
+                'reminder_id': reminder_id,
+                'room_code': room_code,
+                'text': reminder_text(category, task),
+            },
+            # post_init 时调度器尚未启动，等它启动时这些任务已过时；
+            # APScheduler 默认只容忍 1 秒延迟，不放宽的话会被当作错过而丢弃
+            job_kwargs={'misfire_grace_time': None},
         )
+    if rows:
+        logger.info("已恢復 %s 個提醒", len(rows))
 
 async def send_reminder(context: ContextTypes.DEFAULT_TYPE):
     """发送提醒消息"""
     job_data = context.job.data
     room_code = job_data['room_code']
-    task = job_data['task']
-    category = job_data['category']
+    text = job_data['text']
     
-    # 获取房间所有成员
-    members = get_room_members(room_code)
+    # 触发时取当前成员：已离开的不再收到，新加入的也能收到；成员缓存通常命中，无需查库
+    members = await asyncio.to_thread(get_room_members, room_code)
+    
+    reminder_id = job_data.get('reminder_id')
+    if reminder_id and not members:
+        await asyncio.to_thread(mark_reminder_fired, reminder_id)
+        return
+    if reminder_id:
+        # 先登记数量再入队，发送可能在入队循环结束前就完成
+        _reminder_pending[reminder_id] = len(members)
     
+    # 经发送队列限速发出，全部送达后由 _settle_reminder 标记为已触发
     for member_id in members:
-        try:
-            await context.bot.send_message(
-                chat_id=member_id,
-                text=f"⏰ 提醒：{CATEGORIES.get(category, '未知')} - {task}"
-            )
-        except Exception as e:
-            logger.error(f"发送提醒失败给用户 {member_id}: {e}")
+        await enqueue_message(member_id, text, PRIORITY_REMINDER, reminder_id)
 
 # Helper functions
-async def query_all_todos(update: Update, context: ContextTypes.DEFAULT_TYPE, room_code: str):
-    todos = get_todos(room_code)
+def split_message(message, limit=MAX_MESSAGE_CHARS):
+    """按行把过长的消息切成多段，每段不超过 limit 个字符"""
+    chunks = []
+    current = ""
+    for line in message.split("\n"):
+        line = line[:limit]
+        if current and len(current) + len(line) + 1 > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    chunks.append(current)
+    return chunks
+
+def format_all_todos(todos):
+    """一次 join 拼出所有待办，避免循环中反复拼接字符串"""
+    lines = [TEXTS['all_tasks'], '']
+    lines.extend(f"• {CATEGORIES.get(category_id, '未知')} - {task}" for _, _, category_id, task, _ in todos)
+    return "\n".join(lines)
+
+async def query_all_todos(update: Update, context: ContextTypes.DEFAULT_TYPE, room_code: str, page: int = 0):
+    todos = await asyncio.to_thread(get_todos, room_code, page=page)
     if not todos:
         await update.message.reply_text(TEXTS['no_tasks'])
         return
     
-    message = TEXTS['all_tasks'] + "\n\n"
-    for todo_id, user_id, category_id, task, created_at in todos:
-        category_name = CATEGORIES.get(category_id, "未知")
-        message += f"• {category_name} - {task}\n"
-    
-    await update.message.reply_text(message)
+    chunks = split_message(format_all_todos(todos))
+    for chunk in chunks[:-1]:
+        await update.message.reply_text(chunk)
+    await update.message.reply_text(chunks[-1], reply_markup=get_todos_page_keyboard(page, todos))
+
+async def edit_if_changed(query, context, text, reply_markup=None):
+    """内容与该消息上次编辑的相同时跳过（返回 False），避免 "message is not modified" 错误和多余的往返"""
+    markup = reply_markup.to_json() if reply_markup else ''
+    digest = hashlib.blake2b(f"{text}\0{markup}".encode(), digest_size=8).digest()
+    key = (query.message.chat_id, query.message.message_id, digest)
+    # 只记住最近一次编辑，连点同一按钮时命中
+    if context.user_data.get('last_edit') == key:
+        return False
+    # 先记下再编辑，连点时并发的第二次也会被跳过；编辑失败则清除，允许重试
+    context.user_data['last_edit'] = key
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except Exception:
+        context.user_data.pop('last_edit', None)
+        raise
+    return True
 
-async def query_all_todos_from_callback(query, context: ContextTypes.DEFAULT_TYPE, room_code: str):
-    todos = get_todos(room_code)
+async def query_all_todos_from_callback(query, context: ContextTypes.DEFAULT_TYPE, room_code: str, page: int = 0):
+    todos = await asyncio.to_thread(get_todos, room_code, page=page)
     if not todos:
-        await query.edit_message_text(TEXTS['no_tasks'])
+        await query.edit_message_text(TEXTS['no_more_tasks'] if page else TEXTS['no_tasks'])
         return
     
-    message = TEXTS['all_tasks'] + "\n\n"
-    for todo_id, user_id, category_id, task, created_at in todos:
-        category_name = CATEGORIES.get(category_id, "未知")
-        message += f"• {category_name} - {task}\n"
-    
-    await query.edit_message_text(message)
+    chunks = split_message(format_all_todos(todos))
+    page_keyboard = get_todos_page_keyboard(page, todos)
+    if not await edit_if_changed(
+        query,
+        context,
+        chunks[0],
+        reply_markup=page_keyboard if len(chunks) == 1 else None
+    ):
+        # 同一页已经显示过，后续分段也已发出
+        return
+    for i, chunk in enumerate(chunks[1:], 2):
+        await context.bot.send_message(
+            chat_id=query.message.chat_id,
+            text=chunk,
+            reply_markup=page_keyboard if i == len(chunks) else None
+        )
 
 async def choose_category(update: Update, context: ContextTypes.DEFAULT_TYPE, operation_type: str):
     await update.message.reply_text(
         TEXTS['choose_category'],
-        reply_markup=get_category_keyboard(operation_type)
+        reply_markup=_CATEGORY_KB[operation_type]
     )
 
 async def choose_category_from_callback(query, context: ContextTypes.DEFAULT_TYPE, operation_type: str):
     await query.edit_message_text(
         TEXTS['choose_category'],
-        reply_markup=get_category_keyboard(operation_type)
+        reply_markup=_CATEGORY_KB[operation_type]
     )
 
-async def show_todos_by_category(query, context: ContextTypes.DEFAULT_TYPE, room_code: str, category_id: str):
-    todos = get_todos(room_code, category_id)
+async def show_todos_by_category(query, context: ContextTypes.DEFAULT_TYPE, room_code: str, category_id: str, page: int = 0):
+    todos = await asyncio.to_thread(get_todos, room_code, category_id, page)
     if not todos:
-        await query.edit_message_text(TEXTS['no_tasks_category'])
+        await query.edit_message_text(TEXTS['no_more_tasks'] if page else TEXTS['no_tasks_category'])
         return
     
     category_name = CATEGORIES.get(category_id, "未知")
-    message = TEXTS['tasks_in_category'].format(category_name) + "\n\n"
-    for todo_id, user_id, category, task, created_at in todos:
-        message += f"• {task}\n"
-    
-    await query.edit_message_text(message)
+    lines = [TEXTS['tasks_in_category'].format(category_name), '']
+    lines.extend(f"• {task}" for _, _, _, task, _ in todos)
+    
+    chunks = split_message("\n".join(lines))
+    page_keyboard = get_todos_page_keyboard(page, todos, f'cpage_{category_id}')
+    if not await edit_if_changed(
+        query,
+        context,
+        chunks[0],
+        reply_markup=page_keyboard if len(chunks) == 1 else None
+    ):
+        return
+    for i, chunk in enumerate(chunks[1:], 2):
+        await context.bot.send_message(
+            chat_id=query.message.chat_id,
+            text=chunk,
+            reply_markup=page_keyboard if i == len(chunks) else None
+        )
 
-async def choose_delete(update: Update, context: ContextTypes.DEFAULT_TYPE, room_code: str):
-    todos = get_todos(room_code)
+async def get_room_delete_keyboard(room_code, page=0):
+    """按 (房间, 页码) 缓存删除键盘，并用版本号判断：待办未变化时不再查询和重建"""
+    version = _ROOM_VERSIONS[room_code]
+    cached = _DELETE_KB_CACHE.get((room_code, page))
+    if cached and cached[0] > time.monotonic() and cached[1] == version:
+        return cached[2]
+    # 先记下版本号再查询：查询期间有写入时，缓存会在下次被判定为过期
+    todos = await asyncio.to_thread(get_todos, room_code, page=page)
     if not todos:
+        # 空结果也可能来自查询失败，不缓存
+        return None
+    keyboard = get_delete_keyboard(todos, page)
+    if len(_DELETE_KB_CACHE) >= DELETE_KB_CACHE_MAX:
+        _DELETE_KB_CACHE.clear()
+    _DELETE_KB_CACHE[(room_code, page)] = (time.monotonic() + DELETE_KB_CACHE_TTL, version, keyboard)
+    return keyboard
+
+async def choose_delete(update: Update, context: ContextTypes.DEFAULT_TYPE, room_code: str):
+    keyboard = await get_room_delete_keyboard(room_code)
+    if keyboard is None:
         await update.message.reply_text(TEXTS['no_tasks'])
         return
     
     await update.message.reply_text(
         TEXTS['choose_task_to_delete'],
-        reply_markup=get_delete_keyboard(todos)
+        reply_markup=keyboard
     )
 
-async def choose_delete_from_callback(query, context: ContextTypes.DEFAULT_TYPE, room_code: str):
-    todos = get_todos(room_code)
-    if not todos:
-        await query.edit_message_text(TEXTS['no_tasks'])
+async def choose_delete_from_callback(query, context: ContextTypes.DEFAULT_TYPE, room_code: str, page: int = 0):
+    keyboard = await get_room_delete_keyboard(room_code, page)
+    if keyboard is None:
+        await query.edit_message_text(TEXTS['no_more_tasks'] if page else TEXTS['no_tasks'])
         return
     
     await query.edit_message_text(
         TEXTS['choose_task_to_delete'],
-        reply_markup=get_delete_keyboard(todos)
+        reply_markup=keyboard
     )
 def register_handlers(application):
     """注册所有处理器"""
@@ -1301,75 +1726,144 @@ def register_handlers(application):
     
     logger.info("所有处理器注册完成")
 
+# HTTP 服务器与机器人共用事件循环：提供健康检查，webhook 模式下同时接收 Telegram 的更新
+_web_runner = None
+
+async def _health(request):
+    """健康检查端点立即返回，不等待任何其他操作"""
+    return web.Response(text='OK')
+
+async def _index(request):
+    return web.Response(text='Telegram Bot is running!')
+
+async def _telegram_webhook(request):
+    """校验密钥后把更新放入 PTB 的更新队列，立即返回 200，处理在后台进行"""
+    secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        return web.Response(status=403)
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    if not isinstance(data, dict):
+        return web.Response(status=400)
+    application = request.app['application']
+    await application.update_queue.put(Update.de_json(data, application.bot))
+    return web.Response()
+
+async def start_web_server(application, port):
+    """在当前事件循环上绑定端口（Render要求）"""
+    global _web_runner
+    app = web.Application()
+    app['application'] = application
+    app.router.add_get('/health', _health)
+    app.router.add_get('/', _index)
+    if WEBHOOK_URL:
+        app.router.add_post(WEBHOOK_PATH, _telegram_webhook)
+    # 探针请求很频繁，不写访问日志
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', port).start()
+    _web_runner = runner
+    logger.info("HTTP server started on port %s", port)
+
+async def stop_web_server():
+    if _web_runner:
+        await _web_runner.cleanup()
+
+def init_database():
+    """建立连接池并初始化表结构"""
+    init_db_pool()
+    init_db()
+
+async def run_webhook(application, allowed_updates, stop_signals):
+    """没有 Updater 时自行完成 run_polling 的生命周期：初始化、注册 webhook、等待停止信号、关闭"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in stop_signals:
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    # run_polling/run_webhook 才会调用 post_init/post_shutdown，这里手动调用
+    await application.post_init(application)
+    try:
+        await application.bot.set_webhook(
+            url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=allowed_updates,
+        )
+        await application.start()
+        await stop.wait()
+        # 停止处理新更新，并等待正在处理的更新完成
+        await application.stop()
+    finally:
+        await application.post_shutdown(application)
+        await application.shutdown()
+
 def main():
     """主函数"""
-    init_db()
-    
-    # 1. 创建一个使用自定义超时时间的 Request 对象
-    request = HTTPXRequest(connect_timeout=5.0, read_timeout=5.0)
-    
-    # 2. 将这个 Request 对象传递给 Bot
-    application = Application.builder().token(TOKEN).request(request).build()
-    
-    # 注册处理器
-    register_handlers(application)
-    
-    # 启动一个简单的HTTP服务器来绑定端口（Render要求）
-    port = int(os.environ.get('PORT', 10000))
-    
-    # 使用Flask创建一个简单的HTTP服务器
-    app = Flask(__name__)
-    
-    @app.route('/')
-    def home():
-        return 'Telegram Bot is running!'
-    
-    @app.route('/health')
-    def health_check():
-        # 健康检查端点立即返回，不等待任何其他操作
-        return 'OK', 200
-    
-    # 3. 定义一个优雅关闭的信号处理函数
-    def signal_handler(signum, frame):
-        logger.info(f"Received signal {signum}. Shutting down gracefully...")
+    # 数据库初始化（网络握手）与构建 Application 互不依赖，放到后台线程并行进行
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        db_ready = executor.submit(init_database)
         
-        # 创建一个新的事件循环来运行异步关闭代码
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+        # 1. 创建一个使用自定义超时时间的 Request 对象
+        # 默认连接池只有 1 个连接，并发发送会排队等待；调大以承接广播和突发的回复
+        # HTTP/2 让并发请求复用同一条 TLS 连接（需要 h2，见 requirements.txt）
+        request = HTTPXRequest(
+            connect_timeout=5.0,
+            read_timeout=5.0,
+            write_timeout=5.0,
+            pool_timeout=5.0,
+            connection_pool_size=64,
+            http_version="2",
+        )
         
-        try:
-            # 停止轮询，允许当前正在处理的任务完成
-            if application.running:
-                loop.run_until_complete(application.stop())
-            # 这里可以添加其他清理工作，如关闭数据库连接池
-            logger.info("Bot shutdown complete.")
-        except Exception as e:
-            logger.error(f"Error during shutdown: {e}")
-        finally:
-            loop.close()
+        # 2. 将这个 Request 对象传递给 Bot
+        builder = (
+            Application.builder()
+            .token(TOKEN)
+            .request(request)
+            # 并行处理不同用户的更新，一个慢请求不会阻塞其他用户（DB 调用均已放入线程）
+            .concurrent_updates(True)
+            .post_init(on_startup)
+            .post_shutdown(on_shutdown)
+        )
+        if WEBHOOK_URL:
+            # webhook 模式下更新由我们自己的 aiohttp 路由放入队列，不需要 Updater
+            builder = builder.updater(None)
+        application = builder.build()
         
-        # 在 Render 环境中，最好不要调用 sys.exit()，让平台自然结束进程。
-    
-    # 4. 注册信号处理器（用于接收 Render 的关闭信号）
-    signal.signal(signal.SIGTERM, signal_handler) # Render 发送 SIGTERM 来停止实例
-    signal.signal(signal.SIGINT, signal_handler)  # 用于本地开发的 Ctrl+C
-    
-    logger.info("Starting bot with polling mode...")
-    logger.info(f"HTTP health server started on port {port}")
-    
-    # 5. 在单独的线程中启动Flask应用
-    from threading import Thread
-    flask_thread = Thread(target=lambda: app.run(host='0.0.0.0', port=port, debug=False, use_reloader=False))
-    flask_thread.daemon = True
-    flask_thread.start()
-    
-    # 6. 在主线程中启动机器人轮询
+        # 注册处理器
+        register_handlers(application)
+        
+        # 开始轮询前必须等数据库就绪；连接池创建失败时在这里抛出
+        db_ready.result()
+    
+    # 收到 SIGTERM（Render 停止实例）或 SIGINT（本地 Ctrl+C）时，由 PTB 在其事件循环上停止，
+    # 等待正在处理的更新完成，再执行 post_shutdown
+    stop_signals = (signal.SIGTERM, signal.SIGINT)
+    # 只订阅实际处理的更新类型，Telegram 端就不会推送其他类型
+    allowed_updates = [Update.MESSAGE, Update.CALLBACK_QUERY]
     try:
-        application.run_polling(stop_signals=None) # 将 stop_signals 设为 None，因为我们自己处理信号
+        if WEBHOOK_URL:
+            # 3. webhook 模式：Telegram 把更新 POST 到 aiohttp 服务器的 /telegram，与 /health 共用端口
+            logger.info("Starting bot with webhook mode on port %s...", PORT)
+            asyncio.run(run_webhook(application, allowed_updates, stop_signals))
+        else:
+            logger.info("Starting bot with polling mode...")
+
+            # 3. 启动机器人轮询；HTTP 服务器在 post_init 中于同一事件循环上启动
+            # 长轮询：没有更新时 Telegram 最多挂起 30 秒再返回，有更新时立即成批返回
+            application.run_polling(
+                timeout=POLL_TIMEOUT,
+                poll_interval=0.0,
+                allowed_updates=allowed_updates,
+                stop_signals=stop_signals,
+            )
     except Exception as e:
-        logger.error(f"Polling failed: {e}")
+        logger.error("Bot stopped with error: %s", e)
     finally:
-        logger.info("Main polling loop exited.")
+        logger.info("Main loop exited.")
 
 if __name__ == '__main__':
     main()